@@ -0,0 +1,107 @@
+# bench_user_serialization.py - пропускная способность при высокой задержке Telegram API
+#
+# Сравнивает обработку апдейтов по одному (как без параллелизма) и параллельную
+# обработку задачами с UserSerializationMiddleware. Хендлер имитирует вызов
+# Telegram API через asyncio.sleep, сеть не нужна.
+#
+#   python benchmarks/bench_user_serialization.py --users 50 --updates 5 --latency 0.2
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import Message, Update
+
+from bot import UserSerializationMiddleware
+
+logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+
+def build_updates(bot: Bot, users: int, per_user: int):
+    """Апдейты вперемешку: по одному от каждого пользователя по кругу"""
+    updates = []
+    for n in range(per_user):
+        for uid in range(1, users + 1):
+            update_id = len(updates) + 1
+            updates.append(Update.model_validate({
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": 1700000000,
+                    "chat": {"id": uid, "type": "private"},
+                    "from": {"id": uid, "is_bot": False, "first_name": f"user{uid}"},
+                    "text": f"msg {n}",
+                },
+            }, context={"bot": bot}))
+    return updates
+
+
+def build_dispatcher(latency: float, serialize: bool):
+    dp = Dispatcher()
+    stats = {"in_flight": {}, "overlaps": 0, "order": {}}
+    if serialize:
+        dp.update.outer_middleware(UserSerializationMiddleware())
+
+    @dp.message(F.text)
+    async def handler(m: Message):
+        uid = m.from_user.id
+        stats["in_flight"][uid] = stats["in_flight"].get(uid, 0) + 1
+        if stats["in_flight"][uid] > 1:
+            stats["overlaps"] += 1
+        stats["order"].setdefault(uid, []).append(m.message_id)
+        # Имитация delete_message + answer_photo
+        await asyncio.sleep(latency)
+        stats["in_flight"][uid] -= 1
+
+    return dp, stats
+
+
+async def run_sequential(bot: Bot, updates, latency: float):
+    dp, stats = build_dispatcher(latency, serialize=False)
+    start = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return time.perf_counter() - start, stats
+
+
+async def run_concurrent(bot: Bot, updates, latency: float):
+    dp, stats = build_dispatcher(latency, serialize=True)
+    start = time.perf_counter()
+    await asyncio.gather(*(dp.feed_update(bot, update) for update in updates))
+    return time.perf_counter() - start, stats
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность UserSerializationMiddleware")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=5, help="апдейтов на пользователя")
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка API, сек")
+    args = parser.parse_args()
+
+    bot = Bot(token="42:BENCHMARK")
+    updates = build_updates(bot, args.users, args.updates)
+    total = len(updates)
+    print(f"{total} апдейтов, {args.users} пользователей, задержка API {args.latency * 1000:.0f} мс")
+
+    # Последовательный режим слишком долгий при больших задержках - берём подвыборку
+    sample = updates[:min(total, 100)]
+    seq_time, _ = await run_sequential(bot, sample, args.latency)
+    seq_rate = len(sample) / seq_time
+    print(f"  по одному:            {seq_rate:8.1f} апд/с")
+
+    conc_time, stats = await run_concurrent(bot, updates, args.latency)
+    conc_rate = total / conc_time
+    ordered = all(ids == sorted(ids) for ids in stats["order"].values())
+    print(f"  по пользователям:     {conc_rate:8.1f} апд/с  (x{conc_rate / seq_rate:.1f})")
+    print(f"  пересечений внутри пользователя: {stats['overlaps']}, порядок сохранён: {ordered}")
+
+    await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
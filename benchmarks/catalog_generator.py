@@ -0,0 +1,131 @@
+# catalog_generator.py - синтетические каталоги в формате выгрузки WooCommerce
+#
+# Строки повторяют колонки products_full.csv: названия на кириллице и латинице,
+# HTML в описаниях (включая экранированные \r\n), списки картинок через запятую,
+# пропуски в "Кратком описании" и "Базовой цене". Генерация детерминирована
+# по seed, поэтому замеры на разных запусках сравнимы.
+#
+#   python benchmarks/catalog_generator.py 10000 /tmp/catalog_10k.csv
+import os
+import sys
+import random
+import argparse
+from typing import Dict, Any, List
+
+import pandas as pd
+
+SUBSTANCES = [
+    ("Тестостерон энантат", "Testosterone Enanthate"),
+    ("Тестостерон ципионат", "Testosterone Cypionate"),
+    ("Тестостерон пропионат", "Testosterone Propionate"),
+    ("Тренболон ацетат", "Trenbolone Acetate"),
+    ("Болденон", "Boldenone"),
+    ("Нандролон деканоат", "Nandrolone Decanoate"),
+    ("Мастерон", "Masteron"),
+    ("Примоболан", "Primobolan"),
+    ("Кломифен", "Clomiphene"),
+    ("Тамоксифен", "Tamoxifen"),
+    ("Анастрозол", "Anastrozole"),
+    ("Кленбутерол", "Clenbuterol"),
+    ("Тадалафил", "Tadalafil"),
+    ("Силденафил", "Sildenafil"),
+    ("Оксандролон", "Oxandrolone"),
+    ("Станозолол", "Stanozolol"),
+    ("Метандиенон", "Methandienone"),
+    ("Туринабол", "Turinabol"),
+    ("Гормон роста", "Somatropin"),
+    ("Витамин D3", "Cholecalciferol"),
+]
+BRANDS = ["Balkan Pharmaceuticals", "Pharmacom Labs", "ZPHC", "Radjay", "Canada Peptides",
+          "Vermodje", "SP Laboratories", "Genetic Pharmaceuticals", "Alpha Pharma", "Magnus"]
+DOSES = ["10mg", "25mg", "50mg", "100 мг", "200mg/ml", "250 мг/мл", "300mg/ml", "10 IU"]
+INJECT_FORMS = ["10 мл", "10ml", "ампулы 1 мл", "флакон 10 мл", "1ml x 10 amp"]
+ORAL_FORMS = ["100 таблеток", "50 tablets", "капсулы 30 шт", "60 caps", "блистер 10 таб"]
+PLAIN_FORMS = ["упаковка", "pack", "набор", "курс 4 недели"]
+CATEGORIES = [
+    "Инъекционные препараты", "Инъекционные препараты, Стероиды", "Injectable steroids",
+    "Оральные препараты", "Оральные препараты, ПКТ", "Oral steroids",
+    "ПКТ", "Жиросжигатели", "Пептиды", "Витамины",
+]
+WORDS_RU = ("курс дозировка эффект препарат мышечной массы рельеф сила восстановление "
+            "применение хранить состав активное вещество период полувыведения "
+            "рекомендуется спортсменам опытным новичкам прием после еды").split()
+WORDS_EN = ("quality pharma grade strength muscle result cycle dosage half life "
+            "active substance storage recommended").split()
+TAGS = [("<p>", "</p>"), ("<strong>", "</strong>"), ("<em>", "</em>"), ("<li>", "</li>"),
+        ('<span style="color: #333;">', "</span>")]
+IMAGE_HOSTS = ["https://titanshop.example/wp-content/uploads/2024/05/",
+               "https://cdn.titanshop.example/img/"]
+IMAGE_EXTS = [".jpg", ".jpeg", ".png", ".webp", ".JPG", ".bmp", ""]
+
+CSV_COLUMNS = ["ID", "Артикул", "Имя", "Краткое описание", "Описание", "Наличие",
+               "Базовая цена", "Regular price", "Категории", "Изображения"]
+
+
+def _html_description(r: random.Random, title: str) -> str:
+    """Абзацы с тегами, списками и экранированными переносами, как в выгрузке"""
+    parts = []
+    for _ in range(r.randint(1, 4)):
+        words = [r.choice(WORDS_RU if r.random() < 0.75 else WORDS_EN) for _ in range(r.randint(8, 40))]
+        open_tag, close_tag = r.choice(TAGS)
+        parts.append(f"{open_tag}{' '.join(words).capitalize()}.{close_tag}")
+    if r.random() < 0.5:
+        items = "".join(f"<li>{r.choice(WORDS_RU)}: {r.randint(1, 500)} мг</li>" for _ in range(r.randint(2, 5)))
+        parts.append(f"<ul>{items}</ul>")
+    parts.insert(r.randint(0, len(parts)), f"<h3>{title}</h3>")
+    return r.choice(["\\r\\n", "<br />", "\n"]).join(parts)
+
+
+def _images(r: random.Random, pid: int) -> str:
+    """Список картинок через запятую; бывают пустые и невалидные ссылки"""
+    if r.random() < 0.08:
+        return ""
+    urls = [f"{r.choice(IMAGE_HOSTS)}product-{pid}-{n}{r.choice(IMAGE_EXTS)}" for n in range(r.randint(1, 5))]
+    return ", ".join(urls)
+
+
+def generate_rows(n: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Сырые строки CSV для n товаров"""
+    r = random.Random(seed)
+    rows = []
+    for i in range(n):
+        pid = 1000 + i
+        ru, en = r.choice(SUBSTANCES)
+        category = r.choice(CATEGORIES)
+        lowered = category.lower()
+        forms = INJECT_FORMS if "инъекц" in lowered or "inject" in lowered else (
+            ORAL_FORMS if "ораль" in lowered or "oral" in lowered else PLAIN_FORMS)
+        name = f"{ru if r.random() < 0.6 else en} {r.choice(BRANDS)} {r.choice(DOSES)} {r.choice(forms)}"
+        description = _html_description(r, name)
+
+        price = round(r.uniform(5, 350), 2)
+        rows.append({
+            "ID": pid,
+            "Артикул": f"TS-{pid:06d}",
+            "Имя": name,
+            # Часть товаров без краткого описания - тогда берется полное
+            "Краткое описание": description if r.random() < 0.85 else None,
+            "Описание": description + _html_description(r, en),
+            "Наличие": 1 if r.random() < 0.8 else 0,
+            "Базовая цена": price if r.random() < 0.9 else None,
+            "Regular price": price,
+            "Категории": category,
+            "Изображения": _images(r, pid),
+        })
+    return rows
+
+
+def write_catalog_csv(path: str, n: int, seed: int = 0) -> str:
+    """Пишет синтетический каталог в CSV и возвращает путь"""
+    pd.DataFrame(generate_rows(n, seed), columns=CSV_COLUMNS).to_csv(path, index=False)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Генератор синтетического каталога")
+    parser.add_argument("count", type=int)
+    parser.add_argument("path")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_catalog_csv(args.path, args.count, args.seed)
+    print(f"{args.count} товаров -> {os.path.abspath(args.path)}", file=sys.stderr)
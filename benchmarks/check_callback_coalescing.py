@@ -0,0 +1,94 @@
+# check_callback_coalescing.py - проверка схлопывания нажатий на одном сообщении
+#
+# Прогоняет серии нажатий через настоящие CallbackCoalescingMiddleware и
+# UserSerializationMiddleware (в том же порядке, что в боте) с хендлерами,
+# которые имитируют перерисовку экрана через asyncio.sleep. Пока первый экран
+# рисуется, остальные нажатия ждут очереди. Должен быть нарисован последний
+# запрошенный экран, а устаревшие - выброшены. Расхождение - код выхода 1.
+#
+#   python benchmarks/check_callback_coalescing.py
+import os
+import sys
+import asyncio
+import logging
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import CallbackQuery, Update
+
+from bot import CallbackCoalescingMiddleware, UserSerializationMiddleware
+
+logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+RENDER_LATENCY = 0.05
+
+# (нажатия по порядку, какие экраны должны быть нарисованы)
+SCENARIOS: List[Tuple[List[str], List[str]]] = [
+    # Повтор кнопки, пока она рисуется, - один раз
+    (["prod_1", "prod_1"], ["prod_1"]),
+    # Между одинаковыми нажатиями был другой экран: последний prod_1 - новый запрос
+    (["prod_1", "page_1", "prod_1"], ["prod_1", "prod_1"]),
+    (["page_1", "page_2", "page_2"], ["page_1", "page_2"]),
+    (["page_1", "page_2", "page_3", "page_2"], ["page_1", "page_2"]),
+    # Не экран (корзина) не выбрасывается новыми экранами
+    (["prod_1", "buy_1", "page_1"], ["prod_1", "buy_1", "page_1"]),
+]
+
+
+async def _fake_request(bot, method, timeout=None):
+    return True
+
+
+def build_dispatcher(rendered: List[str]) -> Dispatcher:
+    dp = Dispatcher()
+    coalescing = CallbackCoalescingMiddleware()
+    dp.update.outer_middleware(coalescing.track)
+    dp.update.outer_middleware(UserSerializationMiddleware())
+    dp.callback_query.outer_middleware(coalescing)
+
+    @dp.callback_query(F.data)
+    async def render(c: CallbackQuery):
+        await asyncio.sleep(RENDER_LATENCY)
+        rendered.append(c.data)
+
+    return dp
+
+
+def tap(bot: Bot, n: int, data: str) -> Update:
+    return Update.model_validate({
+        "update_id": n,
+        "callback_query": {
+            "id": str(n),
+            "from": {"id": 1, "is_bot": False, "first_name": "user"},
+            "chat_instance": "c",
+            "data": data,
+            "message": {"message_id": 9, "date": 1700000000, "chat": {"id": 1, "type": "private"}, "text": "x"},
+        },
+    }, context={"bot": bot})
+
+
+async def run(taps: List[str]) -> List[str]:
+    bot = Bot("42:TEST")
+    bot.session.make_request = _fake_request
+    rendered: List[str] = []
+    dp = build_dispatcher(rendered)
+    await asyncio.gather(*(dp.feed_update(bot, tap(bot, n, data)) for n, data in enumerate(taps, 1)))
+    await bot.session.close()
+    return rendered
+
+
+def main():
+    failed = 0
+    for taps, expected in SCENARIOS:
+        rendered = asyncio.run(run(taps))
+        ok = rendered == expected
+        failed += not ok
+        print(f"{'✅' if ok else '❌'} {' -> '.join(taps):<40} нарисовано {rendered}, ожидалось {expected}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
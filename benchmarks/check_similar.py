@@ -0,0 +1,94 @@
+# check_similar.py - сверка "похожих товаров" с точным косинусом TF-IDF
+#
+# build_similar_matrix в большом каталоге ищет соседей только среди кандидатов
+# из ближайших корзин; здесь точный top-k считается в лоб на чистом Python
+# (Counter + math) для случайной выборки товаров. Для каждого товара берётся доля
+# суммы косинусов выбранных соседей от суммы точного top-k. Средняя доля (полнота)
+# меньше --min-ratio - код выхода 1; худшая доля и процент найденных ближайших
+# соседей печатаются для сведения.
+#
+#   python benchmarks/check_similar.py                  # 3000 товаров, 200 в выборке
+#   python benchmarks/check_similar.py --size 100000 --sample 200
+import os
+import sys
+import math
+import time
+import random
+import logging
+import argparse
+import tempfile
+import statistics
+from collections import Counter
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+import bot
+from catalog_generator import CSV_COLUMNS, generate_rows
+
+
+def tfidf_vectors(texts: List[str]) -> List[Dict[str, float]]:
+    """Нормированные TF-IDF векторы с той же токенизацией и весами, что в боте"""
+    counts = [Counter(bot._TOKEN_RE.findall(text)) for text in texts]
+    df = Counter(term for c in counts for term in c)
+    n = len(texts)
+    vectors = []
+    for c in counts:
+        vec = {t: (1 + math.log(cnt)) * (math.log((1 + n) / (1 + df[t])) + 1) for t, cnt in c.items()}
+        norm = math.sqrt(sum(w * w for w in vec.values())) or 1.0
+        vectors.append({t: w / norm for t, w in vec.items()})
+    return vectors
+
+
+def cosine(a: Dict[str, float], b: Dict[str, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(w * b.get(t, 0.0) for t, w in a.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сверка похожих товаров с точным косинусом")
+    parser.add_argument("--size", type=int, default=3000)
+    parser.add_argument("--seed", type=int, default=3)
+    parser.add_argument("--sample", type=int, default=200, help="сколько товаров сверять")
+    parser.add_argument("--min-ratio", type=float, default=0.95,
+                        help="допустимая средняя доля точной суммы top-k")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    rows = generate_rows(args.size, args.seed)
+    with tempfile.TemporaryDirectory(prefix="titanshop-check-") as data_dir:
+        path = os.path.join(data_dir, "catalog.csv")
+        pd.DataFrame(rows, columns=CSV_COLUMNS).to_csv(path, index=False)
+        products = bot.load_products_from_csv(path)
+
+    start = time.perf_counter()
+    similar = bot.build_similar_matrix(products, bot.SIMILAR_TOP_K)
+    built = time.perf_counter() - start
+
+    vectors = tfidf_vectors([bot._similar_text(p) for p in products.values()])
+    sample = random.Random(args.seed).sample(range(len(vectors)), min(args.sample, len(vectors)))
+    ratios, nearest_found = [], 0
+    for i in sample:
+        exact = sorted(((cosine(vectors[i], v), j) for j, v in enumerate(vectors) if j != i), reverse=True)
+        top = [score for score, _ in exact[:bot.SIMILAR_TOP_K] if score > 0]
+        picked = [cosine(vectors[i], vectors[j]) for j in similar[i].tolist() if j >= 0]
+        ratios.append(sum(picked) / sum(top) if top else 1.0)
+        # Точный ближайший сосед среди выбранных (с учетом равных косинусов)
+        nearest_found += not top or any(score >= top[0] - 1e-6 for score in picked)
+
+    recall, worst = statistics.mean(ratios), min(ratios)
+    print(f"Каталог {len(products)} товаров, сборка таблицы {built:.2f} с, выборка {len(sample)}")
+    print(f"  доля точной суммы top-{bot.SIMILAR_TOP_K}: средняя {recall:.4f}, "
+          f"медиана {statistics.median(ratios):.4f}, худшая {worst:.4f}")
+    print(f"  точный ближайший сосед среди выбранных: {nearest_found / len(sample):.1%}")
+    if recall < args.min_ratio:
+        print(f"❌ Хуже порога {args.min_ratio}")
+        sys.exit(1)
+    print("✅ Полнота не ниже порога")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+# run_benchmarks.py - замеры горячих путей каталога, поиска и отрисовки
+#
+# Генерирует синтетические каталоги (catalog_generator.py), прогоняет на них
+# загрузку CSV, категоризацию, очистку HTML, таблицу похожих товаров, поиск,
+# списки категорий, правки цен, клавиатуры и текст корзины (на колоночном
+# PackedCatalog), меряет память на товар (словари против снимка), пишет
+# результаты в JSON и сравнивает их с сохраненной базой (baseline.json).
+# Сравниваются медианы нескольких раундов с поправкой на текущую скорость
+# машины (эталонная нагрузка рядом с каждым замером). Рост больше порога и
+# больше разброса замеров (базы и текущего), вместе с ростом лучшего времени,
+# - регрессия: кейс перемеряется, и если она подтвердилась, выводится.
+# С --fail-on-regression код выхода при этом будет 1.
+#
+# База зависит от машины: после смены железа перезапишите ее через --save-baseline.
+#
+#   python benchmarks/run_benchmarks.py                      # 1k/10k/100k, сравнение с базой
+#   python benchmarks/run_benchmarks.py --sizes 1000,10000   # быстрый прогон
+#   python benchmarks/run_benchmarks.py --save-baseline      # обновить базу
+#   python benchmarks/run_benchmarks.py --fail-on-regression # код выхода 1 при регрессии (CI)
+#
+# Точность похожих товаров проверяет отдельный скрипт check_similar.py.
+import os
+import re
+import sys
+import json
+import time
+import random
+import logging
+import platform
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+from datetime import datetime
+from typing import Dict, Any, List, Callable, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+import bot
+from catalog_generator import CSV_COLUMNS, generate_rows
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, "results.json")
+
+SEARCH_QUERIES = ["тестостерон", "testosterone enanthate", "balkan 250", "кломифен таблеток", "zphc", "мг"]
+CART_ITEMS = 25
+PATCHES = 20
+PER_PAGE = 8
+# Во сколько разбросов замеров медиана может уйти без сигнала о регрессии
+SPREAD_FACTOR = 2.0
+# Меняется вместе с эталонной нагрузкой и расчетом разброса: база с другой версией несравнима
+CALIBRATION_VERSION = 3
+
+# Кейс: (имя, подготовка(контекст) -> (функция замера, число операций за вызов))
+Case = Tuple[str, Callable[[Dict[str, Any]], Tuple[Callable[[], Any], int]]]
+CASES: List[Case] = []
+
+
+def case(name: str):
+    def register(setup):
+        CASES.append((name, setup))
+        return setup
+    return register
+
+
+@case("load_products_from_csv")
+def bench_load(ctx):
+    return lambda: bot.load_products_from_csv(ctx["csv"]), ctx["size"]
+
+
+@case("clean_html")
+def bench_clean_html(ctx):
+    descriptions = [row["Краткое описание"] or row["Описание"] for row in ctx["rows"]]
+
+    def run():
+        for raw in descriptions:
+            bot.clean_html(raw)
+    return run, len(descriptions)
+
+
+@case("categorize_product")
+def bench_categorize(ctx):
+    args = [(p["name"], p["original_category"], p["description"]) for p in ctx["products"].values()]
+
+    def run():
+        for name, category, description in args:
+            bot.categorize_product(name, category, description)
+    return run, len(args)
+
+
+@case("build_similar_matrix")
+def bench_similar(ctx):
+    def run():
+        # Без кэша: замеряем полный пересчет, как при смене текстов каталога
+        bot._similar_cache = (b"", bot._similar_cache[1])
+        bot.build_similar_matrix(ctx["products"])
+    return run, 1
+
+
+@case("search_products")
+def bench_search(ctx):
+    def run():
+        bot.set_catalog(ctx["catalog"])
+        for q in SEARCH_QUERIES:
+            bot.search_products(q)
+    return run, len(SEARCH_QUERIES)
+
+
+@case("category_products[cold]")
+def bench_category_cold(ctx):
+    # Первый заход в cb_oral/cb_inject после перезагрузки каталога
+    def run():
+        bot.set_catalog(ctx["catalog"])
+        bot.category_products("oral")
+        bot.category_products("inject")
+    return run, 2
+
+
+@case("category_products[warm]")
+def bench_category_warm(ctx):
+    bot.set_catalog(ctx["catalog"])
+    bot.category_products("oral")
+    bot.category_products("inject")
+
+    def run():
+        bot.category_products("oral")
+        bot.category_products("inject")
+    return run, 2
+
+
+@case("apply_product_patches")
+def bench_patch(ctx):
+    # Правка цены через /patch или Admin API: новая версия каталога поверх того же снимка
+    pids = random.Random(ctx["size"]).sample(list(ctx["products"]), min(PATCHES, ctx["size"]))
+    bot.set_catalog(ctx["catalog"])
+
+    def run():
+        for i, pid in enumerate(pids):
+            bot.apply_product_patches({pid: {"price": 10.0 + i, "in_stock": bool(i % 2)}})
+    return run, len(pids)
+
+
+@case("category_products[patched]")
+def bench_category_patched(ctx):
+    # Список категории после правки: колонки цены/наличия с оверлеем
+    pids = random.Random(ctx["size"]).sample(list(ctx["products"]), min(PATCHES, ctx["size"]))
+    patched = ctx["catalog"].patched({pid: {"price": 1.0, "in_stock": False} for pid in pids}, 1)
+
+    def run():
+        bot.set_catalog(patched)
+        bot.category_products("oral")
+        bot.category_products("inject")
+    return run, 2
+
+
+@case("products_list_kb")
+def bench_products_list_kb(ctx):
+    bot.set_catalog(ctx["catalog"])
+    lst = bot.category_products("inject")
+    last = max(0, (len(lst) - 1) // PER_PAGE)
+    pages = [0, last // 2, last]
+
+    def run():
+        for page in pages:
+            bot.products_list_kb(lst, page, PER_PAGE, "inject")
+    return run, len(pages)
+
+
+@case("cart_text")
+def bench_cart_text(ctx):
+    bot.set_catalog(ctx["catalog"])
+    user_id = 1
+    cart = bot.get_user_cart(user_id)
+    r = random.Random(ctx["size"])
+    cart["items"] = {pid: r.randint(1, 3) for pid in r.sample(list(ctx["products"]), min(CART_ITEMS, ctx["size"]))}
+
+    def run():
+        bot.cart_text(user_id)
+    return run, 1
+
+
+def measure(fn: Callable[[], Any], repeat: int, budget: float) -> List[float]:
+    """Повторяет замер до repeat раз, но не дольше budget секунд суммарно.
+
+    Первый прогон - прогрев (кэши, ленивые импорты): если на все повторы хватает
+    бюджета, он не учитывается.
+    """
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+    timings = [] if first * repeat <= budget else [first]
+    while len(timings) < repeat and sum(timings) + first <= budget:
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings or [first]
+
+
+def catalog_memory(products: Dict[str, Dict[str, Any]]) -> Dict[str, float]:
+    """Байт на товар: словари, как после load_products_from_csv, и снимок PackedCatalog"""
+    raw = json.dumps(products)
+    tracemalloc.start()
+    copy = json.loads(raw)
+    dict_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del copy
+    count = max(1, len(products))
+    return {"dict": dict_bytes / count, "packed": len(bot.pack_catalog(products)) / count}
+
+
+_CALIBRATION_TEXTS = [
+    f"<p>Тестостерон энантат {i} мг, <strong>Balkan Pharmaceuticals</strong></p>\\r\\n"
+    f"<li>курс дозировка эффект препарат мышечной массы {i}</li>" * 3
+    for i in range(250)
+]
+_CALIBRATION_KEYWORDS = ["ампул", "флакон", "таблетк", "капсул", "oral", "inject", "кленбутерол", "масс"]
+
+
+def _calibration_work():
+    # Словари, JSON и сортировка, регулярки и поиск подстрок в кириллице -
+    # то же, на чем живут кейсы (загрузка, clean_html, categorize_product, поиск)
+    rows = [{"id": str(i), "name": f"товар {i}", "price": i * 0.5} for i in range(5000)]
+    json.loads(json.dumps(rows, ensure_ascii=False))
+    sorted(rows, key=lambda r: r["name"])
+    for text in _CALIBRATION_TEXTS:
+        lowered = re.sub(r"\s+", " ", re.sub(r"<.*?>", "", text)).lower()
+        sum(keyword in lowered for keyword in _CALIBRATION_KEYWORDS)
+
+
+def calibrate() -> float:
+    """Время эталонной нагрузки сейчас, сек (медиана 5 прогонов).
+
+    Виртуалка то и дело на минуты замедляется целиком (в 1.5-2 раза), и это
+    видно по эталону так же, как по кейсам. Деление на эталон, снятый рядом
+    с замером, убирает скорость машины из сравнения с базой.
+    """
+    return statistics.median(measure(_calibration_work, 5, 0.5))
+
+
+def measure_rounds(ctx: Dict[str, Any], cases: List[Case], rounds: int, repeat: int, budget: float) -> Dict[str, Dict[str, Any]]:
+    """Медиана каждого кейса по нескольким раундам, в секундах и в единицах эталона.
+
+    Раунды идут по кругу через все кейсы, чтобы замедление машины не легло
+    целиком на один кейс. relative - медиана по раундам отношения медианы раунда
+    к эталону, spread - медианное отклонение этого отношения от relative (один
+    неудачный раунд его не раздувает; при одном раунде - по прогонам).
+    """
+    timings: Dict[str, List[List[float]]] = {name: [] for name, _ in cases}
+    speeds: Dict[str, List[float]] = {name: [] for name, _ in cases}
+    ops: Dict[str, int] = {}
+    for _ in range(rounds):
+        for name, setup in cases:
+            # Подготовка выставляет общее состояние бота (каталог), поэтому - перед каждым замером
+            fn, ops[name] = setup(ctx)
+            before = calibrate()
+            timings[name].append(measure(fn, repeat, budget))
+            speeds[name].append((before + calibrate()) / 2)
+
+    results = {}
+    for name, runs in timings.items():
+        relative = [statistics.median(t) / speed for t, speed in zip(runs, speeds[name])]
+        # При одном раунде разброс считаем по прогонам внутри него
+        points = relative if len(runs) > 1 else [t / speeds[name][0] for t in runs[0]]
+        center = statistics.median(points)
+        spread = statistics.median(abs(x - center) for x in points)
+        median = statistics.median(statistics.median(t) for t in runs)
+        results[name] = {
+            "seconds": median,
+            "best": min(min(t) for t in runs),
+            "relative": statistics.median(relative),
+            "spread": spread,
+            "calibration": statistics.median(speeds[name]),
+            "rounds": len(runs),
+            "runs": sum(len(t) for t in runs),
+            "ops": ops[name],
+            "us_per_op": median / ops[name] * 1e6,
+        }
+    return results
+
+
+def run_size(size: int, seed: int, rounds: int, repeat: int, budget: float, data_dir: str, only: List[str],
+             is_regression: Callable[[str, Dict[str, Any]], bool]):
+    rows = generate_rows(size, seed)
+    csv = os.path.join(data_dir, f"catalog_{size}_{seed}.csv")
+    pd.DataFrame(rows, columns=CSV_COLUMNS).to_csv(csv, index=False)
+    products = bot.load_products_from_csv(csv)
+    # Без таблицы похожих: ее сборку меряет отдельный кейс
+    ctx = {"size": size, "rows": rows, "csv": csv, "products": products,
+           "catalog": bot.PackedCatalog(bot.pack_catalog(products))}
+
+    memory = {f"{kind}/{size}": value for kind, value in catalog_memory(ctx["products"]).items()}
+    for key, value in memory.items():
+        print(f"  память {key:<29} {value:10.0f} байт/товар")
+
+    cases = [(name, setup) for name, setup in CASES if not only or name in only]
+    measured = measure_rounds(ctx, cases, rounds, repeat, budget)
+
+    results = {}
+    for name, setup in cases:
+        key = f"{name}/{size}"
+        result = measured[name]
+        if is_regression(key, result):
+            # Похоже на регрессию - перемеряем, чтобы не ловить разовое замедление машины
+            retry = measure_rounds(ctx, [(name, setup)], rounds, repeat, budget)[name]
+            if retry["relative"] < result["relative"]:
+                result = retry
+            result["rechecked"] = True
+        results[key] = result
+        spread = result["spread"] * result["calibration"]
+        print(f"  {key:<36} {result['seconds'] * 1000:10.3f} мс ±{spread * 1000:<8.3f}"
+              f" ({result['us_per_op']:10.1f} мкс/оп, {result['runs']} прог.)")
+    return results, memory
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], threshold: float, min_delta: float):
+    """Регрессии: кейсы, медиана которых выросла сильнее допуска.
+
+    База пересчитывается на текущую скорость машины по эталону. Допуск - threshold
+    от базы, но не меньше min_delta и SPREAD_FACTOR разбросов: шум есть и в базе,
+    и в текущем прогоне, поэтому их разбросы складываются. Эталон не повторяет
+    каждый кейс в точности, поэтому дополнительно должно вырасти больше threshold
+    и лучшее время без поправки: смена скорости машины двигает только одно из двух.
+    """
+    regressions = []
+    for key, current in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        scale = current["calibration"]
+        expected = base["relative"] * scale
+        actual = current["relative"] * scale
+        spread = (current["spread"] + base["spread"]) * scale
+        slower = actual - expected > max(expected * threshold, min_delta, SPREAD_FACTOR * spread)
+        if slower and current["best"] > base["best"] * (1 + threshold):
+            ratio = actual / expected if expected else float("inf")
+            regressions.append({"case": key, "baseline": expected, "current": actual, "ratio": ratio})
+    return regressions
+
+
+def machine_info() -> Dict[str, Any]:
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки каталога, поиска и отрисовки")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="размеры каталога через запятую")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rounds", type=int, default=3, help="раундов по всем кейсам")
+    parser.add_argument("--repeat", type=int, default=15, help="максимум прогонов на кейс за раунд")
+    parser.add_argument("--budget", type=float, default=1.0, help="лимит времени на кейс за раунд, сек")
+    parser.add_argument("--cases", default="", help="только эти кейсы (через запятую)")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="куда записать результаты (JSON)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="записать результаты как новую базу")
+    parser.add_argument("--threshold", type=float, default=0.25, help="допустимое замедление (0.25 = +25%%)")
+    parser.add_argument("--min-delta", type=float, default=0.0005, help="игнорировать разницу меньше, сек")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="код выхода 1 при регрессии (для CI; без флага регрессии только выводятся)")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    only = [c.strip() for c in args.cases.split(",") if c.strip()]
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("calibration_version") != CALIBRATION_VERSION:
+            print("⚠️ База снята старой версией скрипта, перезапишите ее через --save-baseline")
+            baseline = None
+
+    def is_regression(key: str, result: Dict[str, Any]) -> bool:
+        return bool(baseline) and bool(compare({key: result}, baseline["results"], args.threshold, args.min_delta))
+
+    results, memory = {}, {}
+    with tempfile.TemporaryDirectory(prefix="titanshop-bench-") as data_dir:
+        for size in sizes:
+            print(f"Каталог {size} товаров:")
+            size_results, size_memory = run_size(
+                size, args.seed, args.rounds, args.repeat, args.budget, data_dir, only, is_regression
+            )
+            results.update(size_results)
+            memory.update(size_memory)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "machine": machine_info(),
+        "seed": args.seed,
+        "calibration_version": CALIBRATION_VERSION,
+        "results": results,
+        "memory_bytes_per_product": memory,
+    }
+
+    regressions = []
+    if baseline:
+        if baseline.get("machine", {}).get("platform") != report["machine"]["platform"]:
+            print("⚠️ База снята на другой машине, сравнение может быть неточным")
+        regressions = compare(results, baseline["results"], args.threshold, args.min_delta)
+        report["baseline"] = os.path.relpath(args.baseline, os.getcwd())
+        for r in regressions:
+            print(f"❌ Регрессия {r['case']}: {r['baseline'] * 1000:.3f} мс -> {r['current'] * 1000:.3f} мс (x{r['ratio']:.2f})")
+        if not regressions:
+            print(f"✅ Регрессий нет (порог +{args.threshold:.0%})")
+    report["regressions"] = regressions
+
+    path = args.baseline if args.save_baseline else args.output
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Результаты: {path}")
+    sys.exit(1 if regressions and args.fail_on_regression else 0)
+
+
+if __name__ == "__main__":
+    main()
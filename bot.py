@@ -4,14 +4,37 @@ import json
 import asyncio
 import logging
 import re
-from typing import Dict, Any, List
+import sys
+import math
+import time
+import mmap
+import queue
+import signal
+import struct
+import tempfile
+import zlib
+import multiprocessing
+import threading
+import bisect
+import hmac
+import hashlib
+import contextvars
+from array import array
+from collections import deque
+from collections.abc import Mapping, Sequence
+from typing import Dict, Any, List, Tuple, Callable, Awaitable, Optional
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 import requests
+from aiohttp import web
 
-from aiogram import Bot, Dispatcher, F, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
 from aiogram.types import Message, CallbackQuery, LabeledPrice, PreCheckoutQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
@@ -39,6 +62,31 @@ CSV_PATH = os.environ.get("CSV_PATH", "products_full.csv")
 SYNC_INTERVAL_SEC = int(os.environ.get("SYNC_INTERVAL_SEC", 600))
 DELIVERY_COST_EUR = float(os.environ.get("DELIVERY_COST_EUR", 20.0))
 
+# Количество процессов-воркеров (шардов по user_id); 1 = обычный однопроцессный режим
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 1))
+# Каталог для общих снимков каталога (tmpfs, если есть). Если в нём кончится место
+# (в Docker /dev/shm по умолчанию 64 МБ), снимки переезжают во временный каталог
+CATALOG_SHM_DIR = os.environ.get(
+    "CATALOG_SHM_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+)
+# Как часто главный процесс проверяет, живы ли воркеры
+WORKER_CHECK_INTERVAL_SEC = float(os.environ.get("WORKER_CHECK_INTERVAL_SEC", 5))
+
+# Админы бота (Telegram ID через запятую) и локальный HTTP API для правки товаров
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()}
+ADMIN_API_HOST = os.environ.get("ADMIN_API_HOST", "127.0.0.1")
+ADMIN_API_PORT = int(os.environ.get("ADMIN_API_PORT", 0))  # 0 = выключен
+ADMIN_API_TOKEN = os.environ.get("ADMIN_API_TOKEN", "")
+
+# Профилирование: PROFILE_ON_START=30s (секунды) или =200 (апдейты) - профиль с запуска
+PROFILE_ON_START = os.environ.get("PROFILE_ON_START", "")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 600))  # предел для режима "N апдейтов"
+
+# Уведомления о поступлении: сообщений в секунду на весь бот (лимит Telegram ~30/с)
+RESTOCK_NOTIFY_RATE = float(os.environ.get("RESTOCK_NOTIFY_RATE", 15))
+
 CRYPTO_WALLETS = {
     "BTC": os.environ.get("CRYPTO_BTC", "your_btc_address"),
     "ETH": os.environ.get("CRYPTO_ETH", "your_eth_address"),
@@ -55,12 +103,27 @@ bot = Bot(
 
 dp = Dispatcher()
 
-PRODUCTS: Dict[str, Dict[str, Any]] = {}
+PRODUCTS: Mapping[str, Dict[str, Any]] = {}  # PackedCatalog после первой загрузки
+CATALOG_VERSION = 0  # Растёт при каждой перезагрузке и точечной правке каталога
 user_carts: Dict[int, Dict[str, Any]] = {}
 user_last_messages: Dict[int, int] = {}
 user_search_state: Dict[int, bool] = {}
 user_current_category: Dict[int, str] = {}  # Запоминаем текущую категорию пользователя
 
+# Шардирование: общий номер опубликованной версии каталога (multiprocessing.Value)
+# и префикс файлов снимков. Главный процесс публикует, воркеры подхватывают.
+_catalog_version_ref = None
+_catalog_prefix = ""
+_is_catalog_publisher = False
+_attached_catalog_version = 0
+_control_queue = None  # Очередь воркер -> главный процесс (правки каталога, профилирование)
+_worker_queues: List[Any] = []  # Очереди апдейтов воркеров (в главном процессе), по ним же идут команды
+
+# Ручные правки цен/наличия: переживают автосинхронизацию, пока CSV не изменится
+_product_patches: Dict[str, Dict[str, Any]] = {}
+_patches_csv_mtime = None
+_admin_api_runner = None
+
 # ----------------------------
 # IMAGE UTILITIES
 # ----------------------------
@@ -293,18 +356,797 @@ def load_products_from_csv(path: str) -> Dict[str, Dict[str, Any]]:
     
     return products
 
-async def load_products():
-    global PRODUCTS
+def _csv_mtime():
+    return os.path.getmtime(CSV_PATH) if os.path.exists(CSV_PATH) else None
+
+def _read_catalog() -> "PackedCatalog":
+    """CSV -> колоночный каталог с похожими товарами (в отдельном потоке)"""
     if os.path.exists(CSV_PATH):
-        PRODUCTS = load_products_from_csv(CSV_PATH)
+        products = load_products_from_csv(CSV_PATH)
     else:
         logger.error(f"❌ Файл {CSV_PATH} не найден!")
-        PRODUCTS = {}
+        products = {}
+    return build_catalog(products)
+
+async def load_products():
+    global _patches_csv_mtime
+    # Ручные правки накладываем поверх, пока CSV не поменяли - тогда он главнее
+    if _product_patches and _csv_mtime() != _patches_csv_mtime:
+        logger.info(f"♻️ CSV изменён, ручные правки сброшены ({len(_product_patches)} товаров)")
+        _product_patches.clear()
+        _patches_csv_mtime = None
+
+    # Разбор CSV, упаковка и похожие товары - раз на версию каталога, не блокируя
+    # event loop: в режиме шардов на нём же polling и рассылка апдейтов воркерам
+    catalog = await asyncio.to_thread(_read_catalog)
+
+    # Правки - оверлеем после сборки: так не теряются и те, что пришли во время неё
+    if _product_patches:
+        catalog = catalog.patched(_product_patches, catalog.version)
+
+    # В режиме шардов каждая перезагрузка становится новой версией общего снимка,
+    # и главный процесс читает её через тот же mmap, что и воркеры
+    if _is_catalog_publisher:
+        catalog = attach_catalog(publish_catalog(catalog))
+    set_catalog(catalog)
 
 async def autosync_loop():
     while True:
         await asyncio.sleep(SYNC_INTERVAL_SEC)
-        await load_products()
+        # Ошибка одной синхронизации не должна останавливать следующие
+        try:
+            await load_products()
+        except Exception as e:
+            logger.exception(f"❌ Ошибка синхронизации каталога: {e}")
+
+# ----------------------------
+# CATALOG VERSIONS - ВЕРСИИ КАТАЛОГА И СПИСКИ КАТЕГОРИЙ
+# ----------------------------
+# PRODUCTS никогда не меняется на месте: каждая версия - новый объект, поэтому
+# хендлер, который уже взял товар или список категории, видит согласованный снимок.
+CATEGORY_KEYWORDS = {
+    "oral": ("ораль", "oral"),
+    "inject": ("инъекц", "inject"),
+}
+
+# kind -> CatalogView поверх колонок снимка, отсортированный по наличию и цене.
+# Списки строятся лениво при первом запросе к версии: векторно это дешевле вставок.
+_category_views: Dict[str, Sequence[Dict[str, Any]]] = {}
+_category_views_version = -1
+
+def category_products(kind: str) -> Sequence[Dict[str, Any]]:
+    """Товары категории ("oral"/"inject"), сначала в наличии, затем по цене"""
+    global _category_views, _category_views_version
+    if _category_views_version != CATALOG_VERSION:
+        _category_views = {}
+        _category_views_version = CATALOG_VERSION
+
+    view = _category_views.get(kind)
+    if view is None:
+        # Фильтр по коду категории и сортировка - векторно по колонкам
+        view = PRODUCTS.category_view(kind)
+        _category_views = {**_category_views, kind: view}
+    return view
+
+def set_catalog(products: "PackedCatalog", version: Optional[int] = None, changed: Optional[List[str]] = None):
+    """Переключает PRODUCTS на новую версию каталога.
+
+    changed - ID товаров, у которых поменялись только цена/наличие: поступления
+    проверяются только по ним.
+    """
+    global PRODUCTS, CATALOG_VERSION
+    collect_restocks(products, changed)
+    PRODUCTS = products
+    CATALOG_VERSION = CATALOG_VERSION + 1 if version is None else version
+
+# ----------------------------
+# SHARED CATALOG - ОБЩИЙ СНИМОК КАТАЛОГА ДЛЯ ВОРКЕРОВ
+# ----------------------------
+# Формат снимка: MAGIC | длина заголовка (uint64) | JSON-заголовок | секции.
+# Секции выровнены по 8 байт: числовые колонки (NumPy) и строковые блобы,
+# где каждая строка завершается \0, а границы лежат в колонке "<поле>_off".
+# Категории хранятся кодами (сами строки - в заголовке), а описание не дублируется:
+# это кусок поискового текста search_lc плюс список символов, где регистр отличается.
+# Воркеры читают снимок через mmap напрямую, без копии в каждом процессе.
+# Правка цен/наличия публикуется не снимком, а файлом <версия>.patch.json:
+# номер снимка и весь оверлей цен/наличия поверх него (см. PackedCatalog.patched).
+CATALOG_MAGIC = b"TSCAT002"
+CATALOG_STRING_FIELDS = ("name", "image", "sku")
+
+def _pack_strings(values: List[str]) -> Tuple[bytes, np.ndarray]:
+    """Склеивает строки в один блоб и строит таблицу смещений"""
+    encoded = [v.encode("utf-8") + b"\0" for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded)))
+    return b"".join(encoded), offsets
+
+def _case_exceptions(originals: List[str], lowered: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Где строки отличаются от своих версий в нижнем регистре (той же длины).
+
+    Возвращает смещения по строкам, позиции символов и исходные коды символов.
+    """
+    counts = np.zeros(len(originals), dtype=np.int64)
+    positions, chars = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.uint32)]
+    for start in range(0, len(originals), 4096):
+        chunk = originals[start:start + 4096]
+        a = np.frombuffer("".join(chunk).encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        b = np.frombuffer("".join(lowered[start:start + 4096]).encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        diff = np.flatnonzero(a != b)
+        bounds = np.cumsum([0] + [len(text) for text in chunk])
+        owner = np.searchsorted(bounds, diff, side="right") - 1
+        counts[start:start + len(chunk)] = np.bincount(owner, minlength=len(chunk))
+        positions.append((diff - bounds[owner]).astype(np.int32))
+        chars.append(a[diff])
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    return offsets, np.concatenate(positions), np.concatenate(chars)
+
+def pack_catalog(
+    products: Dict[str, Dict[str, Any]],
+    version: int = 0,
+    similar: Optional[np.ndarray] = None,
+) -> bytes:
+    """Упаковывает каталог в плоский бинарный снимок с поисковым индексом и похожими товарами"""
+    items = list(products.values())
+    # ID товаров всегда числовые (см. load_products_from_csv)
+    ids = np.array([int(p["id"]) for p in items], dtype=np.int64)
+    order = np.argsort(ids, kind="stable")
+
+    # Категорий единицы, товаров тысячи: в колонке код, строка - в заголовке
+    categories: Dict[str, int] = {}
+    original_categories: Dict[str, int] = {}
+    sections: Dict[str, Any] = {
+        "version": np.array([version], dtype=np.int64),
+        "ids": ids,
+        "sorted_ids": ids[order],
+        "order": order.astype(np.int64),
+        "price": np.array([float(p["price"]) for p in items], dtype=np.float64),
+        "in_stock": np.array([bool(p["in_stock"]) for p in items], dtype=np.uint8),
+        "category_code": np.array(
+            [categories.setdefault(p["category"], len(categories)) for p in items], dtype=np.int32
+        ),
+        "original_category_code": np.array(
+            [original_categories.setdefault(p.get("original_category", ""), len(original_categories)) for p in items],
+            dtype=np.int32,
+        ),
+    }
+
+    strings = {field: [str(p.get(field, "")) for p in items] for field in CATALOG_STRING_FIELDS}
+    # Поисковый индекс: те же строки, что сравнивает search_products, в нижнем регистре
+    strings["name_lc"] = [name.lower() for name in strings["name"]]
+    strings["search_lc"] = []
+    # Описание - участок search_lc [начало, конец) в байтах от начала записи;
+    # если нижний регистр меняет длину строки, описание лежит целиком в "description"
+    description_span = np.zeros((len(items), 2), dtype=np.uint32)
+    strings["description"] = [""] * len(items)
+    originals, lowered = [""] * len(items), [""] * len(items)
+    for i, p in enumerate(items):
+        name_lc, description = strings["name_lc"][i], str(p.get("description", ""))
+        description_lc = description.lower()
+        text = f"{p['name']} {description} {p['category']} {p.get('sku', '')}".lower()
+        strings["search_lc"].append(text)
+        if len(description_lc) == len(description) and text.startswith(f"{name_lc} {description_lc} "):
+            start = len(name_lc.encode("utf-8")) + 1
+            description_span[i] = (start, start + len(description_lc.encode("utf-8")))
+            originals[i], lowered[i] = description, description_lc
+        else:
+            strings["description"][i] = description
+    sections["description_span"] = description_span.ravel()
+    (sections["description_case_off"], sections["description_case_pos"],
+     sections["description_case_char"]) = _case_exceptions(originals, lowered)
+
+    for field, values in strings.items():
+        sections[field], sections[f"{field}_off"] = _pack_strings(values)
+
+    # Похожие товары: матрица count x similar_k позиций в снимке (-1 = пусто)
+    if similar is None:
+        similar = np.zeros((len(items), 0), dtype=np.int32)
+    similar_k = similar.shape[1]
+    sections["similar"] = similar.astype(np.int32).ravel()
+
+    header = {
+        "count": len(items),
+        "similar_k": similar_k,
+        "categories": list(categories),
+        "original_categories": list(original_categories),
+        "sections": {},
+    }
+    body = bytearray()
+    for name, value in sections.items():
+        body.extend(b"\0" * (-len(body) % 8))
+        if isinstance(value, np.ndarray):
+            raw, dtype = value.tobytes(), value.dtype.str
+        else:
+            raw, dtype = value, ""
+        header["sections"][name] = [len(body), len(raw), dtype]
+        body.extend(raw)
+
+    header_raw = json.dumps(header).encode("utf-8")
+    header_raw += b" " * (-len(header_raw) % 8)
+    return CATALOG_MAGIC + struct.pack("<Q", len(header_raw)) + header_raw + bytes(body)
+
+class PackedCatalog(Mapping):
+    """Read-only словарь товаров поверх упакованного снимка (bytes или mmap).
+
+    Правки цены и наличия не трогают снимок: они лежат в маленьком оверлее
+    {позиция: (цена, наличие)}, общем для всех версий после последней перезагрузки.
+    """
+
+    def __init__(self, buf):
+        if bytes(buf[:8]) != CATALOG_MAGIC:
+            raise ValueError("Неизвестный формат снимка каталога")
+        (header_len,) = struct.unpack_from("<Q", buf, 8)
+        header = json.loads(bytes(buf[16:16 + header_len]))
+        base = 16 + header_len
+
+        self._buf = buf
+        self._count = header["count"]
+        self._similar_k = header["similar_k"]
+        self._categories: List[str] = header["categories"]
+        self._original_categories: List[str] = header["original_categories"]
+        self._sections: Dict[str, Any] = {}
+        for name, (offset, length, dtype) in header["sections"].items():
+            if dtype:
+                self._sections[name] = np.frombuffer(
+                    buf, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=base + offset
+                )
+            else:
+                # Для блоба храним абсолютные границы в буфере
+                self._sections[name] = (base + offset, base + offset + length)
+
+        self._version: Optional[int] = None
+        self._overlay: Dict[int, Tuple[float, bool]] = {}
+        self._columns: Dict[str, np.ndarray] = {}  # price/in_stock с наложенным оверлеем
+
+    @property
+    def version(self) -> int:
+        return self.snapshot_version if self._version is None else self._version
+
+    @property
+    def snapshot_version(self) -> int:
+        """Версия, под которой опубликован сам снимок (без учёта оверлея)"""
+        return int(self._sections["version"][0])
+
+    def patched(self, changes: Dict[str, Dict[str, Any]], version: int) -> "PackedCatalog":
+        """Новая версия с другими ценами/наличием поверх того же снимка, без копии буфера"""
+        copy = object.__new__(PackedCatalog)
+        copy.__dict__.update(self.__dict__)
+        copy._version = version
+        copy._overlay = dict(self._overlay)
+        copy._columns = {}
+        for pid, change in changes.items():
+            i = self._index(pid)
+            if i < 0:
+                continue
+            price, in_stock = self._price_stock(i)
+            copy._overlay[i] = (float(change.get("price", price)), bool(change.get("in_stock", in_stock)))
+        return copy
+
+    def overlay(self) -> Dict[str, Dict[str, Any]]:
+        """Оверлей в виде правок {pid: {"price", "in_stock"}} - для публикации воркерам"""
+        ids = self._sections["ids"]
+        return {
+            str(int(ids[i])): {"price": price, "in_stock": in_stock}
+            for i, (price, in_stock) in self._overlay.items()
+        }
+
+    def to_bytes(self, version: int) -> bytearray:
+        """Полная копия снимка с новой версией и вписанным оверлеем"""
+        buf = bytearray(self._buf)
+        copy = PackedCatalog(buf)
+        copy._sections["version"][0] = version
+        if self._overlay:
+            copy._sections["price"][:] = self._column("price")
+            copy._sections["in_stock"][:] = self._column("in_stock")
+        return buf
+
+    def _price_stock(self, i: int) -> Tuple[float, bool]:
+        patch = self._overlay.get(i)
+        if patch is not None:
+            return patch
+        return float(self._sections["price"][i]), bool(self._sections["in_stock"][i])
+
+    def _column(self, name: str) -> np.ndarray:
+        """Колонка price или in_stock с учётом оверлея (копия строится раз на версию)"""
+        if not self._overlay:
+            return self._sections[name]
+        column = self._columns.get(name)
+        if column is None:
+            field = 0 if name == "price" else 1
+            column = self._sections[name].copy()
+            column[list(self._overlay)] = [patch[field] for patch in self._overlay.values()]
+            self._columns[name] = column
+        return column
+
+    def _index(self, pid) -> int:
+        """Позиция товара в снимке или -1"""
+        try:
+            key = int(pid)
+        except (TypeError, ValueError):
+            return -1
+        if str(key) != str(pid):
+            return -1
+        sorted_ids = self._sections["sorted_ids"]
+        pos = int(np.searchsorted(sorted_ids, key))
+        if pos < len(sorted_ids) and sorted_ids[pos] == key:
+            return int(self._sections["order"][pos])
+        return -1
+
+    def _string(self, field: str, i: int) -> str:
+        start, _ = self._sections[field]
+        offsets = self._sections[f"{field}_off"]
+        return self._buf[start + int(offsets[i]):start + int(offsets[i + 1]) - 1].decode("utf-8")
+
+    def _description(self, i: int) -> str:
+        """Описание из search_lc с восстановленным регистром"""
+        raw = self._string("description", i)
+        if raw:
+            return raw
+        start, _ = self._sections["search_lc"]
+        start += int(self._sections["search_lc_off"][i])
+        lo, hi = self._sections["description_span"][2 * i:2 * i + 2].tolist()
+        text = self._buf[start + lo:start + hi].decode("utf-8")
+
+        offsets = self._sections["description_case_off"]
+        a, b = int(offsets[i]), int(offsets[i + 1])
+        if a == b:
+            return text
+        parts, prev = [], 0
+        positions = self._sections["description_case_pos"][a:b].tolist()
+        for pos, char in zip(positions, self._sections["description_case_char"][a:b].tolist()):
+            parts.append(text[prev:pos])
+            parts.append(chr(char))
+            prev = pos + 1
+        parts.append(text[prev:])
+        return "".join(parts)
+
+    def record(self, i: int) -> Dict[str, Any]:
+        """Собирает dict товара в том же виде, что и load_products_from_csv"""
+        price, in_stock = self._price_stock(i)
+        return {
+            "id": str(int(self._sections["ids"][i])),
+            "name": self._string("name", i),
+            "description": self._description(i),
+            "price": price,
+            "category": self._categories[self._sections["category_code"][i]],
+            "original_category": self._original_categories[self._sections["original_category_code"][i]],
+            "image": self._string("image", i),
+            "in_stock": in_stock,
+            "sku": self._string("sku", i),
+        }
+
+    def __getitem__(self, pid) -> Dict[str, Any]:
+        i = self._index(pid)
+        if i < 0:
+            raise KeyError(pid)
+        return self.record(i)
+
+    def __contains__(self, pid) -> bool:
+        return self._index(pid) >= 0
+
+    def __iter__(self):
+        return (str(pid) for pid in self._sections["ids"].tolist())
+
+    def __len__(self) -> int:
+        return self._count
+
+    def values(self):
+        return (self.record(i) for i in range(self._count))
+
+    def similar(self, pid) -> List[str]:
+        """ID похожих товаров из предпосчитанной матрицы"""
+        i = self._index(pid)
+        if i < 0 or not self._similar_k:
+            return []
+        row = self._sections["similar"][i * self._similar_k:(i + 1) * self._similar_k]
+        ids = self._sections["ids"]
+        return [str(int(ids[j])) for j in row if j >= 0]
+
+    def _category_mask(self, matches: Callable[[str], bool]) -> np.ndarray:
+        """Маска товаров, чья категория подходит под условие (проверка по таблице кодов)"""
+        table = np.array([matches(category) for category in self._categories], dtype=bool)
+        return table[self._sections["category_code"]] if self._count else np.zeros(0, dtype=bool)
+
+    def category_view(self, kind: str) -> "CatalogView":
+        """Товары категории ("oral"/"inject"), сначала в наличии, затем по цене"""
+        keywords = CATEGORY_KEYWORDS[kind]
+        positions = np.flatnonzero(self._category_mask(lambda c: any(k in c.lower() for k in keywords)))
+        # Две стабильные сортировки = ключ (-наличие, цена, позиция в каталоге)
+        positions = positions[np.argsort(self._column("price")[positions], kind="stable")]
+        positions = positions[np.argsort(self._column("in_stock")[positions] == 0, kind="stable")]
+        return CatalogView(self, positions)
+
+    def _matches(self, field: str, needle: bytes) -> np.ndarray:
+        """Позиции записей, в строке `field` которых встречается needle"""
+        start, end = self._sections[field]
+        offsets = self._sections[f"{field}_off"]
+        hits = []
+        pos = self._buf.find(needle, start, end)
+        while pos != -1:
+            i = int(np.searchsorted(offsets, pos - start, side="right")) - 1
+            hits.append(i)
+            # Остальные вхождения в ту же запись не нужны - прыгаем к следующей
+            pos = self._buf.find(needle, start + int(offsets[i + 1]), end)
+        return np.array(hits, dtype=np.int64)
+
+    def search(self, q: str, limit: int = 15) -> List[Dict[str, Any]]:
+        """Поиск с тем же скорингом, что и search_products, но по индексу снимка"""
+        q = q.lower().strip()
+        if len(q) < 2:
+            return []
+
+        search_words = q.split()
+        score = np.zeros(self._count, dtype=np.int64)
+        matched = np.zeros(self._count, dtype=np.int64)
+
+        score[self._matches("name_lc", q.encode("utf-8"))] += 100
+        for word in search_words:
+            matched[self._matches("search_lc", word.encode("utf-8"))] += 1
+        score[matched == len(search_words)] += 50
+        score += matched * 10
+        score[self._category_mask(lambda c: q in c.lower())] += 25
+
+        # Сортируем по релевантности, затем по наличию, затем по цене
+        hits = np.flatnonzero(score > 0)
+        in_stock = self._column("in_stock")[hits].astype(np.int64)
+        hits = hits[np.lexsort((self._column("price")[hits], -in_stock, -score[hits]))]
+
+        results = []
+        for i in hits[:limit].tolist():
+            p = self.record(i)
+            p["_search_score"] = int(score[i])
+            results.append(p)
+        return results
+
+class CatalogView(Sequence):
+    """Список товаров поверх PackedCatalog: хранит позиции, записи собирает только для страницы"""
+
+    def __init__(self, catalog: PackedCatalog, positions: np.ndarray):
+        self._catalog = catalog
+        self._positions = positions
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._catalog.record(i) for i in self._positions[index].tolist()]
+        return self._catalog.record(int(self._positions[index]))
+
+def build_catalog(products: Dict[str, Dict[str, Any]]) -> PackedCatalog:
+    """Колоночный каталог из словарей load_products_from_csv"""
+    return PackedCatalog(pack_catalog(products, similar=build_similar_matrix(products)))
+
+def catalog_snapshot_path(version: int) -> str:
+    return f"{_catalog_prefix}-{version}.bin"
+
+def catalog_patch_path(version: int) -> str:
+    return f"{_catalog_prefix}-{version}.patch.json"
+
+def _fallback_catalog_prefix() -> str:
+    """Префикс снимков во временном каталоге - на случай, если CATALOG_SHM_DIR переполнен"""
+    return os.path.join(tempfile.gettempdir(), os.path.basename(_catalog_prefix))
+
+def _catalog_prefixes() -> List[str]:
+    """Где могут лежать файлы версий: CATALOG_SHM_DIR и запасной временный каталог"""
+    shm = os.path.join(CATALOG_SHM_DIR, os.path.basename(_catalog_prefix))
+    return list(dict.fromkeys([_catalog_prefix, shm, _fallback_catalog_prefix()]))
+
+def remove_catalog_snapshot(version: int):
+    """Удаляет файлы версии из всех мест, где они могут лежать"""
+    for prefix in _catalog_prefixes():
+        for suffix in (".bin", ".bin.tmp", ".patch.json", ".patch.json.tmp"):
+            path = f"{prefix}-{version}{suffix}"
+            if os.path.exists(path):
+                os.remove(path)
+
+def _write_catalog_file(path: str, data: bytes):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+def _write_published(version: int, path: Callable[[int], str], data: bytes):
+    """Пишет файл версии; при ошибке (переполнен /dev/shm) переезжает во временный каталог"""
+    global _catalog_prefix
+    try:
+        _write_catalog_file(path(version), data)
+    except OSError as e:
+        fallback = _fallback_catalog_prefix()
+        remove_catalog_snapshot(version)
+        if fallback == _catalog_prefix:
+            raise
+        # Воркеры ищут файлы версий в обоих местах (_catalog_prefixes)
+        logger.warning(f"⚠️ Не удалось записать снимок в {os.path.dirname(_catalog_prefix)} ({e}), "
+                       f"переезжаем в {os.path.dirname(fallback)}")
+        _catalog_prefix = fallback
+        _write_catalog_file(path(version), data)
+
+# Опубликованные версии (в главном процессе): версия -> номер её полного снимка
+_published_snapshots: Dict[int, int] = {}
+
+def _finish_publish(version: int, snapshot: int):
+    _published_snapshots[version] = snapshot
+    _catalog_version_ref.value = version
+
+    # Предыдущую версию не трогаем: воркер мог прочитать её номер, но ещё не открыть файл.
+    # Уже открытые mmap переживают удаление файла.
+    keep = {version, version - 1}
+    keep |= {_published_snapshots[v] for v in keep if v in _published_snapshots}
+    for old in [v for v in _published_snapshots if v not in keep]:
+        remove_catalog_snapshot(old)
+        del _published_snapshots[old]
+
+def publish_catalog(catalog: PackedCatalog) -> int:
+    """Записывает полный снимок новой версии и атомарно переключает на него все шарды"""
+    version = _catalog_version_ref.value + 1
+    _write_published(version, catalog_snapshot_path, catalog.to_bytes(version))
+    _finish_publish(version, version)
+    logger.info(f"📤 Опубликована версия каталога v{version} ({len(catalog)} товаров)")
+    return version
+
+def publish_catalog_patch(catalog: PackedCatalog, changed: List[str]) -> int:
+    """Публикует правку цен/наличия: маленький файл с оверлеем поверх уже опубликованного снимка.
+
+    changed - ID изменённых товаров: воркеры проверят поступления только по ним.
+    """
+    version = catalog.version
+    patch = {
+        "base": _catalog_version_ref.value,
+        "snapshot": catalog.snapshot_version,
+        "changed": changed,
+        "overlay": catalog.overlay(),
+    }
+    _write_published(version, catalog_patch_path, json.dumps(patch).encode("utf-8"))
+    _finish_publish(version, catalog.snapshot_version)
+    logger.info(f"📤 Опубликована правка каталога v{version} ({len(changed)} товаров)")
+    return version
+
+def attach_catalog(version: int) -> PackedCatalog:
+    """Открывает снимок версии `version` через mmap"""
+    for prefix in _catalog_prefixes():
+        try:
+            f = open(f"{prefix}-{version}.bin", "rb")
+        except FileNotFoundError:
+            # Главный процесс мог переехать из переполненного CATALOG_SHM_DIR
+            continue
+        with f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return PackedCatalog(mm)
+    raise FileNotFoundError(catalog_snapshot_path(version))
+
+def _read_catalog_patch(version: int) -> Optional[Dict[str, Any]]:
+    """Файл правки версии `version`; None - версия опубликована полным снимком"""
+    for prefix in _catalog_prefixes():
+        try:
+            with open(f"{prefix}-{version}.patch.json") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            continue
+    return None
+
+def refresh_shared_catalog():
+    """Подхватывает последнюю опубликованную версию каталога (в воркере)"""
+    global _attached_catalog_version
+    version = _catalog_version_ref.value
+    if version == _attached_catalog_version:
+        return
+    changed = None
+    try:
+        patch = _read_catalog_patch(version)
+        if patch is None:
+            catalog = attach_catalog(version)
+        else:
+            # Правка цен/наличия: снимок тот же, если он уже открыт - новый mmap не нужен
+            snapshot = PRODUCTS
+            if not isinstance(snapshot, PackedCatalog) or snapshot.snapshot_version != patch["snapshot"]:
+                snapshot = attach_catalog(patch["snapshot"])
+            catalog = snapshot.patched(patch["overlay"], version)
+            if patch["base"] == _attached_catalog_version:
+                changed = patch["changed"]
+    except FileNotFoundError:
+        # Успели опубликовать ещё более новую версию - подхватим её на следующем апдейте
+        return
+
+    set_catalog(catalog, version, changed)
+    _attached_catalog_version = version
+    logger.info(f"📥 Воркер переключился на каталог v{version}")
+
+# ----------------------------
+# PRODUCT PATCHES - ТОЧЕЧНАЯ ПРАВКА ЦЕН И НАЛИЧИЯ
+# ----------------------------
+def normalize_product_patch(change: Dict[str, Any]) -> Dict[str, Any]:
+    """Проверяет правку {"price": float, "in_stock": bool}; ValueError при ошибке"""
+    if not isinstance(change, dict) or not change:
+        raise ValueError("пустая правка")
+    unknown = set(change) - {"price", "in_stock"}
+    if unknown:
+        raise ValueError(f"неизвестные поля: {', '.join(sorted(unknown))}")
+
+    result = {}
+    if "price" in change:
+        try:
+            price = float(str(change["price"]).replace(",", "."))
+        except ValueError:
+            raise ValueError(f"некорректная цена: {change['price']}")
+        if not math.isfinite(price):
+            raise ValueError(f"некорректная цена: {change['price']}")
+        if price < 0:
+            raise ValueError("цена должна быть неотрицательной")
+        result["price"] = price
+    if "in_stock" in change:
+        value = change["in_stock"]
+        if isinstance(value, str):
+            value = value.strip().lower()
+            if value not in ("1", "0", "true", "false", "yes", "no", "да", "нет"):
+                raise ValueError(f"непонятное наличие: {value}")
+            value = value in ("1", "true", "yes", "да")
+        result["in_stock"] = bool(value)
+    return result
+
+def apply_product_patches(changes: Dict[str, Dict[str, Any]]) -> int:
+    """Copy-on-write: новая версия каталога, в которой заменены только изменённые товары"""
+    global _patches_csv_mtime
+    # Снимок общий с прошлой версией, меняется только оверлей цен и наличия
+    products = PRODUCTS.patched(changes, CATALOG_VERSION + 1)
+    for pid, change in changes.items():
+        _product_patches.setdefault(pid, {}).update(change)
+    _patches_csv_mtime = _csv_mtime()
+
+    if _is_catalog_publisher:
+        publish_catalog_patch(products, list(changes))
+    set_catalog(products, changed=list(changes))
+
+    for pid, change in changes.items():
+        logger.info(f"✏️ Товар {pid} изменён: {change} (каталог v{CATALOG_VERSION})")
+    return CATALOG_VERSION
+
+def submit_product_patches(changes: Dict[str, Dict[str, Any]]) -> bool:
+    """Применяет правку; в воркере передаёт её главному процессу. True - применено сразу"""
+    if _control_queue is not None:
+        _control_queue.put(("patch", changes))
+        return False
+    apply_product_patches(changes)
+    return True
+
+async def admin_api_patch_product(request: web.Request) -> web.Response:
+    """PATCH /products/{pid} {"price": 12.5, "in_stock": false}"""
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode(), f"Bearer {ADMIN_API_TOKEN}".encode()):
+        return web.json_response({"error": "unauthorized"}, status=401)
+
+    pid = request.match_info["pid"]
+    if pid not in PRODUCTS:
+        return web.json_response({"error": "product not found"}, status=404)
+    try:
+        change = normalize_product_patch(await request.json())
+    except (ValueError, TypeError) as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    # Пока читали тело, перезагрузка каталога могла убрать товар
+    if pid not in PRODUCTS:
+        return web.json_response({"error": "product not found"}, status=404)
+    version = apply_product_patches({pid: change})
+    p = PRODUCTS[pid]
+    return web.json_response({"id": pid, "price": p["price"], "in_stock": p["in_stock"], "version": version})
+
+async def start_admin_api():
+    """Поднимает локальный HTTP API, если заданы ADMIN_API_PORT и ADMIN_API_TOKEN"""
+    global _admin_api_runner
+    if not (ADMIN_API_PORT and ADMIN_API_TOKEN):
+        return
+    app = web.Application()
+    app.router.add_route("PATCH", "/products/{pid}", admin_api_patch_product)
+    _admin_api_runner = web.AppRunner(app)
+    await _admin_api_runner.setup()
+    await web.TCPSite(_admin_api_runner, ADMIN_API_HOST, ADMIN_API_PORT).start()
+    logger.info(f"🛠 Admin API: http://{ADMIN_API_HOST}:{ADMIN_API_PORT}/products/<id>")
+
+async def _control_loop(control):
+    """Главный процесс: принимает правки каталога от воркеров"""
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await loop.run_in_executor(None, _next_shard_update, control)
+        if not message:
+            continue
+        kind, payload = message
+        if kind == "patch":
+            known = {pid: change for pid, change in payload.items() if pid in PRODUCTS}
+            if known:
+                apply_product_patches(known)
+        elif kind == "profile":
+            spec, chat_id = payload
+            await _profile_all_processes(spec, chat_id)
+        elif kind == "profile_done":
+            if _profile_reports is not None:
+                _profile_reports.put_nowait(payload)
+
+# ----------------------------
+# RESTOCK NOTIFICATIONS - УВЕДОМЛЕНИЯ О ПОСТУПЛЕНИИ
+# ----------------------------
+# Кто открыл карточку отсутствующего товара или получил отказ в cb_buy, подписан
+# на товар. Подписчики - отсортированный array("q") из user_id: 8 байт на
+# подписку, без дублей. При смене версии каталога проверяются только товары с
+# подписчиками; рассылка идёт фоном пачками, не быстрее RESTOCK_NOTIFY_RATE
+# сообщений в секунду на весь бот, чтобы ответам пользователям хватало лимита API.
+_restock_subscribers: Dict[str, array] = {}
+# Рассылки в работе: [pid, подписчики, сколько уже обработано, сколько доставлено]
+_restock_jobs: deque = deque()
+_restock_wakeup: Optional[asyncio.Event] = None
+
+def subscribe_restock(user_id: int, pid: str) -> bool:
+    """Подписывает пользователя на поступление товара. False - уже подписан"""
+    subscribers = _restock_subscribers.get(pid)
+    if subscribers is None:
+        subscribers = _restock_subscribers[pid] = array("q")
+    i = bisect.bisect_left(subscribers, user_id)
+    if i < len(subscribers) and subscribers[i] == user_id:
+        return False
+    subscribers.insert(i, user_id)
+    return True
+
+def collect_restocks(products, changed: Optional[List[str]] = None) -> List[str]:
+    """Ставит в рассылку товары с подписчиками, которые появились в новой версии каталога"""
+    candidates = _restock_subscribers if changed is None else [pid for pid in changed if pid in _restock_subscribers]
+    restocked = []
+    for pid in candidates:
+        p = products.get(pid)
+        # Подписка оформляется только на отсутствующий товар, так что наличие = поступление
+        if p is not None and p["in_stock"]:
+            restocked.append(pid)
+    for pid in restocked:
+        _restock_jobs.append([pid, _restock_subscribers.pop(pid), 0, 0])
+    if restocked and _restock_wakeup is not None:
+        _restock_wakeup.set()
+    return restocked
+
+async def _send_restock(user_id: int, p: Dict[str, Any]) -> bool:
+    text = f"🔔 *{p['name']}* снова в наличии!\n💰 Цена: €{p['price']}"
+    for _ in range(3):
+        try:
+            await bot.send_message(user_id, text, reply_markup=restock_kb(p["id"]))
+            return True
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            # Пользователь заблокировал бота, удалил чат и т.п.
+            logger.debug(f"Не удалось уведомить {user_id} о товаре {p['id']}: {e}")
+            return False
+    return False
+
+async def restock_fanout_loop():
+    """Фоновая рассылка: по пачке от каждого товара по кругу, в пределах лимита"""
+    global _restock_wakeup
+    _restock_wakeup = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    # В режиме шардов лимит делится между воркерами: у каждого свои подписчики
+    rate = RESTOCK_NOTIFY_RATE / max(1, WORKER_PROCESSES)
+    batch = max(1, int(rate))
+
+    while True:
+        if not _restock_jobs:
+            _restock_wakeup.clear()
+            await _restock_wakeup.wait()
+            continue
+
+        job = _restock_jobs.popleft()
+        pid, subscribers, offset, delivered = job
+        p = PRODUCTS.get(pid)
+        if p is None or not p["in_stock"]:
+            # Товар снова закончился - оставшиеся дождутся следующего поступления
+            for user_id in subscribers[offset:]:
+                subscribe_restock(user_id, pid)
+            logger.info(f"🔔 Товар {pid} закончился во время рассылки: уведомлено {delivered}")
+            continue
+
+        started = loop.time()
+        chunk = subscribers[offset:offset + batch]
+        results = await asyncio.gather(*(_send_restock(user_id, p) for user_id in chunk))
+        job[2] = offset + len(chunk)
+        job[3] = delivered + sum(results)
+        if job[2] < len(subscribers):
+            _restock_jobs.append(job)
+        else:
+            logger.info(f"🔔 {p['name']}: уведомлено {job[3]} из {len(subscribers)} подписчиков")
+        await asyncio.sleep(max(0.0, len(chunk) / rate - (loop.time() - started)))
 
 # ----------------------------
 # MESSAGE MANAGEMENT
@@ -368,10 +1210,17 @@ def products_list_kb(lst, page=0, per_page=8, category=""):
 def product_card_kb(pid):
     kb = InlineKeyboardBuilder()
     kb.button(text="🛒 Добавить в корзину", callback_data=f"buy_{pid}")
+    for p in similar_products(pid):
+        kb.button(text=f"🔗 {p['name'][:35]}", callback_data=f"prod_{p['id']}")
     kb.button(text="⬅ К товарам", callback_data="back_to_category")
     kb.adjust(1)
     return kb.as_markup()
 
+def restock_kb(pid):
+    kb = InlineKeyboardBuilder()
+    kb.button(text="👀 Открыть товар", callback_data=f"prod_{pid}")
+    return kb.as_markup()
+
 def search_kb():
     """Клавиатура для поиска"""
     kb = InlineKeyboardBuilder()
@@ -382,43 +1231,648 @@ def search_kb():
 # SEARCH - УЛУЧШЕННАЯ ВЕРСИЯ
 # ----------------------------
 def search_products(q: str):
-    """Улучшенный поиск товаров"""
-    q = q.lower().strip()
-    if len(q) < 2:
-        return []
-    
-    results = []
-    search_words = q.split()
-    
-    for p in PRODUCTS.values():
-        # Поиск в названии, описании, категории и артикуле
-        searchable_text = f"{p['name']} {p['description']} {p['category']} {p.get('sku', '')}".lower()
-        
-        score = 0
-        
-        # Точное совпадение в названии (максимальный приоритет)
-        if q in p['name'].lower():
-            score += 100
-        
-        # Совпадение всех слов запроса
-        if all(word in searchable_text for word in search_words):
-            score += 50
-        
-        # Частичное совпадение
-        word_matches = sum(1 for word in search_words if word in searchable_text)
-        score += word_matches * 10
-        
-        # Совпадение в категории
-        if q in p['category'].lower():
-            score += 25
-        
-        if score > 0:
-            p['_search_score'] = score
-            results.append(p)
-    
-    # Сортируем по релевантности, затем по наличию, затем по цене
-    results.sort(key=lambda x: (-x.get('_search_score', 0), -x['in_stock'], x['price']))
-    return results[:15]  # Ограничиваем 15 результатами
+    """Улучшенный поиск товаров: название, описание, категория и артикул (см. PackedCatalog.search)"""
+    return PRODUCTS.search(q)
+
+# ----------------------------
+# SIMILAR PRODUCTS - ПОХОЖИЕ ТОВАРЫ (TF-IDF)
+# ----------------------------
+SIMILAR_TOP_K = 3
+# До стольких товаров близости считаются точно, полным перебором пар
+SIMILAR_EXACT_MAX = 2000
+SIMILAR_BLOCK_CELLS = 16_000_000  # Ячеек float32 в блоке плотной матрицы (~64 МБ)
+# Кандидаты для большого каталога: слепок TF-IDF, корзины k-means и перебор соседних корзин
+SIMILAR_SKETCH_DIMS = 256
+SIMILAR_CLUSTER_SIZE = 256  # Товаров в корзине в среднем
+SIMILAR_KMEANS_ITERS = 6
+SIMILAR_PROBES = 6  # Сколько ближайших корзин (включая свою) перебирать
+SIMILAR_CANDIDATES = 16  # Сколько кандидатов на товар пересчитывать точно
+_TOKEN_RE = re.compile(r"\w{2,}")
+# (ключ текстов товаров, таблица похожих) последней сборки
+_similar_cache: Tuple[bytes, np.ndarray] = (b"", np.zeros((0, SIMILAR_TOP_K), dtype=np.int32))
+
+def _similar_text(p: Dict[str, Any]) -> str:
+    # Название повторяем, чтобы оно весило больше описания
+    return f"{p['name']} {p['name']} {p['category']} {p['description']}".lower()
+
+def _tokenize_catalog(texts: List[str]) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Токены всех товаров: (номер товара, номер слова) для каждого вхождения и размер словаря.
+
+    Регулярка гоняется только по уникальным "сырым" словам после split(), а не по
+    всему тексту: на кириллице это в разы быстрее.
+    """
+    raw = " \0 ".join(texts).split()
+    codes, uniques = pd.factorize(np.array(raw, dtype=object))
+
+    vocab: Dict[str, int] = {}
+    clean_ids: List[int] = []
+    clean_len = np.zeros(len(uniques), dtype=np.int64)
+    for i, word in enumerate(uniques):
+        tokens = _TOKEN_RE.findall(word)
+        clean_ids.extend(vocab.setdefault(t, len(vocab)) for t in tokens)
+        clean_len[i] = len(tokens)
+    clean_start = np.r_[0, np.cumsum(clean_len)[:-1]]
+
+    # Разделитель "\0" не даёт токенов, зато отмечает границы товаров
+    separator = pd.Index(uniques).get_indexer(["\0"])[0]  # -1, если товар один
+    raw_doc = np.cumsum(codes == separator)
+
+    lengths = clean_len[codes]
+    docs = np.repeat(raw_doc, lengths)
+    pos = np.repeat(clean_start[codes] - np.r_[0, np.cumsum(lengths)[:-1]], lengths) + np.arange(lengths.sum())
+    terms = np.array(clean_ids, dtype=np.int64)[pos]
+    return docs, terms, len(vocab)
+
+def _tfidf(texts: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """TF-IDF в COO-виде: (товар, слово, вес) по уникальным парам, отсортированным по товару, и df слов.
+
+    tf = 1 + ln(count), idf = ln((1 + n) / (1 + df)) + 1, строки нормированы (L2),
+    так что скалярное произведение строк - косинусная близость товаров.
+    """
+    n = len(texts)
+    docs, terms, vocab_size = _tokenize_catalog(texts)
+    if not vocab_size:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0), empty
+
+    keys = np.sort(docs * vocab_size + terms)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    doc, term = keys[starts] // vocab_size, keys[starts] % vocab_size
+
+    df = np.bincount(term, minlength=vocab_size)
+    idf = np.log((1 + n) / (1 + df)) + 1
+    weight = (1 + np.log(counts)) * idf[term]
+    weight /= np.sqrt(np.bincount(doc, weights=weight ** 2, minlength=n))[doc]
+    return doc, term, weight, df
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Номера k лучших столбцов каждой строки по убыванию близости, -1 - если близость не больше нуля"""
+    best = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    return np.where(np.take_along_axis(scores, best, axis=1) > 0, best, -1)
+
+def _similar_exact(doc: np.ndarray, term: np.ndarray, weight: np.ndarray,
+                   n: int, vocab_size: int, k: int) -> np.ndarray:
+    """Точный top-k: плотная матрица X @ X.T блоками строк (для небольших каталогов)"""
+    result = np.full((n, k), -1, dtype=np.int32)
+    matrix = np.zeros((n, vocab_size), dtype=np.float32)
+    matrix[doc, term] = weight
+    step = max(1, SIMILAR_BLOCK_CELLS // n)
+    for lo in range(0, n, step):
+        hi = min(n, lo + step)
+        scores = matrix[lo:hi] @ matrix.T
+        scores[np.arange(hi - lo), np.arange(lo, hi)] = -np.inf
+        top = _top_k(scores, k)
+        result[lo:hi, :top.shape[1]] = top
+    return result
+
+def _sketch(doc: np.ndarray, term: np.ndarray, weight: np.ndarray, doc_ptr: np.ndarray,
+            vocab_size: int, rng: np.random.Generator) -> np.ndarray:
+    """Слепок TF-IDF: каждое слово со случайным знаком попадает в две из SIMILAR_SKETCH_DIMS ячеек.
+
+    Скалярное произведение слепков в среднем равно косинусу исходных строк,
+    а матрица n x 256 помещается в память и перемножается BLAS'ом.
+    """
+    n, dims = len(doc_ptr) - 1, SIMILAR_SKETCH_DIMS
+    cells = rng.integers(0, dims, size=(2, vocab_size))
+    signs = rng.choice(np.array([-1.0, 1.0]), size=(2, vocab_size)) / np.sqrt(2)
+    sketch = np.zeros((n, dims), dtype=np.float32)
+    step = max(1, SIMILAR_BLOCK_CELLS // 4 // dims)
+    for lo in range(0, n, step):
+        hi = min(n, lo + step)
+        a, b = doc_ptr[lo], doc_ptr[hi]
+        d, t, w = doc[a:b] - lo, term[a:b], weight[a:b]
+        block = np.zeros((hi - lo) * dims)
+        for h in range(2):
+            block += np.bincount(d * dims + cells[h, t], weights=w * signs[h, t], minlength=len(block))
+        sketch[lo:hi] = block.reshape(hi - lo, dims)
+    sketch /= np.maximum(np.linalg.norm(sketch, axis=1, keepdims=True), 1e-12)
+    return sketch
+
+def _nearest_centroid(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    step = max(1, SIMILAR_BLOCK_CELLS // 4 // len(centroids))
+    return np.concatenate([
+        (points[lo:lo + step] @ centroids.T).argmax(axis=1) for lo in range(0, len(points), step)
+    ])
+
+def _similar_candidates(sketch: np.ndarray, rng: np.random.Generator, count: int) -> np.ndarray:
+    """Кандидаты в похожие (n x count, -1 = нет): лучшие по слепку в SIMILAR_PROBES ближайших корзинах.
+
+    Корзины - сферический k-means по слепкам, обученный на выборке. Каждая корзина
+    сравнивается только с соседними, так что работа растёт линейно с каталогом.
+    """
+    n = len(sketch)
+    clusters = max(1, n // SIMILAR_CLUSTER_SIZE)
+    train = sketch[np.sort(rng.choice(n, min(n, 32 * clusters), replace=False))]
+    centroids = train[rng.choice(len(train), clusters, replace=False)]
+    for _ in range(SIMILAR_KMEANS_ITERS):
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, _nearest_centroid(train, centroids), train)
+        # Опустевшая корзина сохраняет старый центр
+        empty = ~sums.any(axis=1)
+        sums[empty] = centroids[empty]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+    assign = _nearest_centroid(sketch, centroids)
+    order = np.argsort(assign, kind="stable")
+    bounds = np.r_[0, np.cumsum(np.bincount(assign, minlength=clusters))]
+    probes = np.argsort(-(centroids @ centroids.T), axis=1)[:, :SIMILAR_PROBES]
+
+    candidates = np.full((n, count), -1, dtype=np.int64)
+    for c in range(clusters):
+        rows = order[bounds[c]:bounds[c + 1]]
+        cols = np.concatenate([order[bounds[p]:bounds[p + 1]] for p in probes[c]])
+        r = min(count, len(cols) - 1)
+        if not len(rows) or r < 1:
+            continue
+        scores = sketch[rows] @ sketch[cols].T
+        scores[rows[:, None] == cols[None, :]] = -np.inf
+        candidates[rows, :r] = cols[np.argpartition(-scores, r - 1, axis=1)[:, :r]]
+    return candidates
+
+def _rescore(candidates: np.ndarray, term: np.ndarray, weight: np.ndarray, doc_ptr: np.ndarray,
+             vocab_size: int, k: int) -> np.ndarray:
+    """Точный косинус TF-IDF до каждого кандидата и top-k по нему"""
+    n, count = candidates.shape
+    result = np.full((n, k), -1, dtype=np.int32)
+    step = max(1, SIMILAR_BLOCK_CELLS // vocab_size)
+    for lo in range(0, n, step):
+        hi = min(n, lo + step)
+        a, b = doc_ptr[lo], doc_ptr[hi]
+        rows = np.zeros((hi - lo, vocab_size), dtype=np.float32)
+        rows[np.repeat(np.arange(hi - lo), np.diff(doc_ptr[lo:hi + 1])), term[a:b]] = weight[a:b]
+
+        block = candidates[lo:hi]
+        flat = np.maximum(block, 0).ravel()
+        # Все слова всех кандидатов подряд, pair - номер пары (товар, кандидат)
+        lengths = doc_ptr[flat + 1] - doc_ptr[flat]
+        pos = np.repeat(doc_ptr[flat] - np.r_[0, np.cumsum(lengths)[:-1]], lengths) + np.arange(lengths.sum())
+        pair = np.repeat(np.arange(len(flat)), lengths)
+        scores = np.bincount(pair, weights=rows[pair // count, term[pos]] * weight[pos], minlength=len(flat))
+        scores = scores.reshape(hi - lo, count)
+        scores[block < 0] = -np.inf
+
+        top = _top_k(scores, k)
+        result[lo:hi, :top.shape[1]] = np.where(
+            top >= 0, np.take_along_axis(block, np.maximum(top, 0), axis=1), -1
+        )
+    return result
+
+def build_similar_matrix(products: Dict[str, Dict[str, Any]], k: int = SIMILAR_TOP_K) -> np.ndarray:
+    """Top-k похожих товаров по косинусу TF-IDF (строки в порядке products, -1 = нет соседа).
+
+    До SIMILAR_EXACT_MAX товаров считается точно. В большом каталоге полный перебор
+    пар квадратичен, поэтому кандидаты берутся из соседних корзин k-means по слепкам
+    TF-IDF, а между ними выбор делается по точному косинусу. Таблица кэшируется по
+    текстам товаров: перезагрузка с теми же названиями и описаниями её не пересчитывает.
+    """
+    global _similar_cache
+    n = len(products)
+    result = np.full((n, k), -1, dtype=np.int32)
+    if n < 2 or k < 1:
+        return result
+
+    texts = [_similar_text(p) for p in products.values()]
+    key = hashlib.sha1(f"{k}\0{chr(1).join(texts)}".encode("utf-8")).digest()
+    if _similar_cache[0] == key:
+        return _similar_cache[1]
+
+    doc, term, weight, df = _tfidf(texts)
+    vocab_size = len(df)
+    if vocab_size and n <= SIMILAR_EXACT_MAX and n * vocab_size <= SIMILAR_BLOCK_CELLS:
+        result = _similar_exact(doc, term, weight, n, vocab_size, k)
+    elif vocab_size:
+        # Фиксированное зерно: одинаковый каталог даёт одинаковые соседи в каждом процессе
+        rng = np.random.default_rng(0)
+        doc_ptr = np.r_[0, np.cumsum(np.bincount(doc, minlength=n))]
+        candidates = _similar_candidates(_sketch(doc, term, weight, doc_ptr, vocab_size, rng),
+                                         rng, max(SIMILAR_CANDIDATES, k))
+        result = _rescore(candidates, term, weight, doc_ptr, vocab_size, k)
+
+    _similar_cache = (key, result)
+    return result
+
+def similar_products(pid: str) -> List[Dict[str, Any]]:
+    """Похожие товары для карточки: только поиск в заранее посчитанной таблице"""
+    return [PRODUCTS[sid] for sid in PRODUCTS.similar(pid) if sid in PRODUCTS]
+
+# ----------------------------
+# CALLBACK COALESCING
+# ----------------------------
+# Колбэки, которые только перерисовывают экран: если пока такой колбэк ждал
+# своей очереди пользователь запросил другой экран, старый можно не рисовать
+VIEW_CALLBACK_PREFIXES = ("page_", "prod_")
+
+# Счётчик запросов к Telegram API в рамках текущего апдейта
+_api_call_counter: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar(
+    "api_call_counter", default=None
+)
+
+class ApiCallCounterMiddleware(BaseRequestMiddleware):
+    """Считает запросы к API, сделанные хендлером колбэка"""
+
+    async def __call__(self, make_request, bot, method):
+        counter = _api_call_counter.get()
+        if counter is not None:
+            counter[0] += 1
+        return await make_request(bot, method)
+
+class CallbackCoalescingMiddleware:
+    """Схлопывает повторные нажатия одной кнопки и выбрасывает устаревшие перерисовки.
+
+    Ключ - (user_id, message_id). Регистрируется дважды: track() на уровне апдейтов
+    ДО UserSerializationMiddleware (видит нажатия, пока они ждут очереди), а сам
+    объект - на callback_query, то есть уже после получения замка пользователя.
+    """
+
+    def __init__(self):
+        # (user_id, message_id) -> {"pending": {callback_data: сколько в работе},
+        #                            "view": номер последнего экрана, "last": его callback_data, "refs": int}
+        self._slots: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        # Среднее число запросов к API на колбэк по видам ("page", "prod", "buy", ...)
+        self._calls: Dict[str, List[float]] = {}
+        self.collapsed = 0
+        self.dropped_stale = 0
+        self.saved_api_calls = 0.0
+
+    @staticmethod
+    def _kind(callback_data: str) -> str:
+        return callback_data.split("_", 1)[0]
+
+    def _record_calls(self, kind: str, calls: int):
+        total = self._calls.setdefault(kind, [0.0, 0.0])
+        total[0] += calls
+        total[1] += 1
+
+    def _skip(self, kind: str) -> float:
+        """Сколько запросов сэкономлено пропуском колбэка (минус наш собственный answer)"""
+        total = self._calls.get(kind)
+        if not total or not total[1]:
+            return 0.0
+        return max(total[0] / total[1] - 1, 0.0)
+
+    async def track(self, handler, event: types.Update, data: Dict[str, Any]) -> Any:
+        c = event.callback_query
+        if c is None or c.message is None or not c.data:
+            return await handler(event, data)
+
+        key = (c.from_user.id, c.message.message_id)
+        kind = self._kind(c.data)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = {"pending": {}, "view": 0, "last": None, "refs": 0}
+
+        is_view = c.data.startswith(VIEW_CALLBACK_PREFIXES)
+        # Экран схлопываем, только если он и есть последний запрошенный: после
+        # prod_1, page_1 повторный prod_1 - новый запрос, его надо нарисовать
+        if c.data in slot["pending"] and (not is_view or c.data == slot["last"]):
+            # Такое же нажатие уже в работе - второй раз экран не строим
+            self.collapsed += 1
+            self.saved_api_calls += self._skip(kind)
+            await c.answer()
+            return None
+
+        slot["pending"][c.data] = slot["pending"].get(c.data, 0) + 1
+        slot["refs"] += 1
+        if is_view:
+            slot["view"] += 1
+            slot["last"] = c.data
+            data["coalesce_ticket"] = (key, slot["view"])
+
+        counter = [0]
+        token = _api_call_counter.set(counter)
+        try:
+            return await handler(event, data)
+        finally:
+            _api_call_counter.reset(token)
+            if counter[0]:
+                self._record_calls(kind, counter[0])
+            slot["pending"][c.data] -= 1
+            if not slot["pending"][c.data]:
+                del slot["pending"][c.data]
+            slot["refs"] -= 1
+            if slot["refs"] == 0:
+                del self._slots[key]
+
+    async def __call__(self, handler, event: CallbackQuery, data: Dict[str, Any]) -> Any:
+        ticket = data.get("coalesce_ticket")
+        if ticket is not None:
+            key, view = ticket
+            slot = self._slots.get(key)
+            if slot is not None and slot["view"] != view:
+                # Пока ждали очереди, пользователь запросил более новый экран
+                self.dropped_stale += 1
+                self.saved_api_calls += self._skip(self._kind(event.data))
+                await event.answer()
+                return None
+        return await handler(event, data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "collapsed": self.collapsed,
+            "dropped_stale": self.dropped_stale,
+            "saved_api_calls": int(round(self.saved_api_calls)),
+        }
+
+callback_coalescing = CallbackCoalescingMiddleware()
+bot.session.middleware(ApiCallCounterMiddleware())
+# Порядок важен: track() должен стоять раньше замка пользователя
+dp.update.outer_middleware(callback_coalescing.track)
+dp.callback_query.outer_middleware(callback_coalescing)
+
+# ----------------------------
+# PER-USER SERIALIZATION
+# ----------------------------
+class UserSerializationMiddleware(BaseMiddleware):
+    """Апдейты разных пользователей идут параллельно, одного пользователя - строго по очереди.
+
+    Хендлеры меняют корзину, user_last_messages и флаг _awaiting_address без
+    синхронизации, поэтому два апдейта одного пользователя не должны пересекаться.
+    """
+
+    def __init__(self):
+        # user_id -> [asyncio.Lock, число апдейтов пользователя в работе/в очереди]
+        self._locks: Dict[int, list] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        entry = self._locks.get(user.id)
+        if entry is None:
+            entry = self._locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                # Пользователь простаивает - замок больше не нужен
+                del self._locks[user.id]
+
+    @property
+    def active_users(self) -> int:
+        return len(self._locks)
+
+user_serialization = UserSerializationMiddleware()
+dp.update.outer_middleware(user_serialization)
+
+# ----------------------------
+# PROFILING - ПРОФИЛИРОВАНИЕ НА ЛЕТУ
+# ----------------------------
+# Статистический сэмплер: отдельный поток раз в PROFILE_INTERVAL_MS снимает стеки
+# всех потоков процесса (event loop, пул с перезагрузкой каталога) и копит их в
+# формате folded ("поток;кадр;кадр N"), который читают flamegraph.pl, speedscope
+# и inferno. Пока профиль не запущен, потока нет, а апдейт платит одной проверкой.
+# Ожидание в select/очередях - простой, такие сэмплы не пишем
+PROFILE_IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+_profiler = None  # Текущий StackProfiler этого процесса
+
+def _frame_label(code) -> str:
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackProfiler:
+    """Сэмплирующий профайлер на N секунд или N апдейтов"""
+
+    def __init__(self, seconds: Optional[float] = None, updates: Optional[int] = None):
+        self.seconds = seconds
+        self.max_updates = updates
+        self.updates = 0
+        self.samples: Dict[str, int] = {}
+        self.path: Optional[str] = None
+        self.notify_chat: Optional[int] = None  # Куда прислать итог (команда /profile)
+        self.started = time.time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    @property
+    def sample_count(self) -> int:
+        return sum(self.samples.values())
+
+    @property
+    def active(self) -> bool:
+        return self._thread.is_alive()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self):
+        self._thread.join()
+
+    def update_done(self):
+        if self._stop.is_set():
+            return
+        self.updates += 1
+        if self.max_updates and self.updates >= self.max_updates:
+            self._stop.set()
+
+    def _sample(self, own: int):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in PROFILE_IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            key = ";".join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def _run(self):
+        global _profiler
+        own = threading.get_ident()
+        deadline = self.started + (self.seconds or PROFILE_MAX_SECONDS)
+        while not self._stop.wait(PROFILE_INTERVAL_MS / 1000):
+            self._sample(own)
+            if time.time() >= deadline:
+                break
+        try:
+            self.path = self._write()
+            logger.info(f"📈 Профиль записан: {self.path} (сэмплов {self.sample_count}, апдейтов {self.updates})")
+        except OSError as e:
+            logger.error(f"❌ Не удалось записать профиль: {e}")
+        if _profiler is self:
+            _profiler = None
+
+    def _write(self) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = datetime.fromtimestamp(self.started).strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(PROFILE_DIR, f"profile-{stamp}-{os.getpid()}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+        return path
+
+def parse_profile_spec(spec: str) -> Tuple[Optional[float], Optional[int]]:
+    """"30s" -> (30.0, None) - по времени, "200" -> (None, 200) - по числу апдейтов"""
+    spec = spec.strip().lower()
+    try:
+        if spec.endswith("s"):
+            seconds = float(spec[:-1])
+            if seconds > 0:
+                return seconds, None
+        else:
+            updates = int(spec)
+            if updates > 0:
+                return None, updates
+    except ValueError:
+        pass
+    raise ValueError(f"некорректный интервал профилирования: {spec!r} (нужно 30s или 200)")
+
+def start_profiling(seconds: Optional[float] = None, updates: Optional[int] = None) -> Optional[StackProfiler]:
+    """Запускает профайлер; None - если он уже идёт"""
+    global _profiler
+    if _profiler is not None and _profiler.active:
+        return None
+    _profiler = StackProfiler(seconds, updates)
+    _profiler.start()
+    limit = f"на {seconds:g} с" if seconds else (f"на {updates} апдейтов" if updates else "до остановки")
+    logger.info(f"📈 Профилирование запущено {limit}")
+    return _profiler
+
+def stop_profiling() -> Optional[StackProfiler]:
+    """Останавливает профайлер и дожидается записи файла"""
+    profiler = _profiler
+    if profiler is None:
+        return None
+    profiler.stop()
+    profiler.join()
+    return profiler
+
+def profile_on_start():
+    """Профиль с запуска процесса по PROFILE_ON_START (захватывает и первую загрузку каталога)"""
+    if not PROFILE_ON_START:
+        return
+    try:
+        start_profiling(*parse_profile_spec(PROFILE_ON_START))
+    except ValueError as e:
+        logger.error(f"❌ PROFILE_ON_START: {e}")
+
+# Режим шардов: профилем управляет главный процесс. Он профилирует себя и рассылает
+# команду всем воркерам по их очередям апдейтов, а воркеры присылают итоги обратно
+# через _control_queue. "N апдейтов" считает главный процесс по всем шардам.
+PROFILE_REPORT_TIMEOUT_SEC = 10  # Сколько ждать итогов воркеров после остановки
+_profile_reports: Optional[asyncio.Queue] = None  # Итоги воркеров (в главном процессе)
+
+def _broadcast_to_workers(message: Tuple[str, Any]):
+    for q in _worker_queues:
+        q.put(message)
+
+async def _profile_all_processes(spec: str, chat_id: int):
+    """Главный процесс: /profile из любого воркера запускает или останавливает профиль везде"""
+    if spec == "stop":
+        profiler = _profiler
+        if profiler is None:
+            await bot.send_message(chat_id, "Профилирование не запущено")
+            return
+        profiler.stop()
+        _broadcast_to_workers(("profile", "stop"))
+        # Профиль с запуска (PROFILE_ON_START) никто не ждёт - отчитываемся здесь
+        if profiler.notify_chat is None:
+            profiler.notify_chat = chat_id
+            await _report_profile(profiler)
+        return
+
+    seconds, updates = parse_profile_spec(spec)
+    profiler = start_profiling(seconds, updates)
+    if profiler is None:
+        await bot.send_message(chat_id, "⏳ Профилирование уже идёт, остановить: `/profile stop`")
+        return
+    profiler.notify_chat = chat_id
+    # Воркеры пишут профиль до остановки из главного процесса (или по своему таймеру)
+    _broadcast_to_workers(("profile", (profiler.started, seconds)))
+    asyncio.create_task(_report_sharded_profile(profiler))
+
+async def _report_sharded_profile(profiler: StackProfiler):
+    """Дожидается конца профиля, останавливает воркеров и присылает общий итог админу"""
+    await asyncio.to_thread(profiler.join)
+    # Профиль по времени воркеры заканчивают по своему таймеру, по числу апдейтов - по команде
+    if profiler.seconds is None:
+        _broadcast_to_workers(("profile", "stop"))
+
+    reports = [{"path": profiler.path, "samples": profiler.sample_count}]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + PROFILE_REPORT_TIMEOUT_SEC
+    while len(reports) <= len(_worker_queues):
+        try:
+            report = await asyncio.wait_for(_profile_reports.get(), max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            break
+        if report["session"] == profiler.started:
+            reports.append(report)
+
+    paths = [r["path"] for r in reports if r["path"]]
+    missing = len(_worker_queues) + 1 - len(paths)
+    text = (
+        f"📈 Профиль готов, процессов: {len(paths)}\n"
+        + "".join(f"`{path}`\n" for path in paths)
+        + f"Сэмплов: {sum(r['samples'] for r in reports)}, апдейтов: {profiler.updates}\n"
+        + (f"⚠️ Нет профиля от {missing} процессов, подробности в логе\n" if missing else "")
+        + "Открыть: flamegraph.pl или speedscope.app"
+    )
+    await bot.send_message(profiler.notify_chat, text)
+
+async def _send_profile_to_main(shard: int, session: float, profiler: StackProfiler):
+    """Воркер: итог своего профиля - главному процессу"""
+    await asyncio.to_thread(profiler.join)
+    _control_queue.put(("profile_done", {
+        "session": session,
+        "shard": shard,
+        "path": profiler.path,
+        "samples": profiler.sample_count,
+    }))
+
+def _shard_command(shard: int, kind: str, payload: Any):
+    """Воркер: команда главного процесса, пришедшая в очереди апдейтов"""
+    if kind == "profile":
+        if payload == "stop":
+            if _profiler is not None:
+                _profiler.stop()
+            return
+        session, seconds = payload
+        profiler = start_profiling(seconds)
+        if profiler is not None:
+            asyncio.create_task(_send_profile_to_main(shard, session, profiler))
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Считает обработанные апдейты для режима "профиль на N апдейтов" """
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        profiler = _profiler
+        if profiler is None:
+            return await handler(event, data)
+        try:
+            return await handler(event, data)
+        finally:
+            profiler.update_done()
+
+dp.update.outer_middleware(ProfilingMiddleware())
 
 # ----------------------------
 # HANDLERS
@@ -438,6 +1892,91 @@ async def cmd_start(m: Message):
     msg = await m.answer(welcome_text, reply_markup=main_menu_kb())
     save_message_id(m.from_user.id, msg.message_id)
 
+@dp.message(F.text.startswith("/patch"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_patch(m: Message):
+    """/patch <ID> price=12.5 stock=0 - точечная правка товара (только для админов)"""
+    usage = "Использование: `/patch <ID> price=12.5 stock=1`"
+    parts = m.text.split()
+    if len(parts) < 3:
+        await m.answer(usage)
+        return
+
+    pid = parts[1]
+    if pid not in PRODUCTS:
+        await m.answer(f"❌ Товар {pid} не найден")
+        return
+
+    try:
+        change = {}
+        for arg in parts[2:]:
+            key, _, value = arg.partition("=")
+            change["in_stock" if key == "stock" else key] = value
+        change = normalize_product_patch(change)
+    except ValueError as e:
+        await m.answer(f"❌ {e}\n\n{usage}")
+        return
+
+    if submit_product_patches({pid: change}):
+        p = PRODUCTS[pid]
+        stock = "✅ В наличии" if p["in_stock"] else "❌ Нет в наличии"
+        await m.answer(f"✏️ *{p['name']}*\n💰 €{p['price']}\n{stock}\n\nКаталог v{CATALOG_VERSION}")
+    else:
+        await m.answer(f"✏️ Правка товара {pid} отправлена, каталог обновится через секунду")
+
+async def _report_profile(profiler: StackProfiler):
+    await asyncio.to_thread(profiler.join)
+    if profiler.path is None:
+        text = "❌ Не удалось записать профиль, подробности в логе"
+    else:
+        text = (
+            f"📈 Профиль готов: `{profiler.path}`\n"
+            f"Сэмплов: {profiler.sample_count}, апдейтов: {profiler.updates}\n"
+            "Открыть: flamegraph.pl или speedscope.app"
+        )
+    await bot.send_message(profiler.notify_chat, text)
+
+@dp.message(F.text.startswith("/profile"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_profile(m: Message):
+    """/profile 30s | /profile 200 | /profile stop - профиль обработки апдейтов (только для админов)"""
+    usage = "Использование: `/profile 30s`, `/profile 200` или `/profile stop`"
+    parts = m.text.split()
+    spec = parts[1] if len(parts) > 1 else "30s"
+
+    if spec != "stop":
+        try:
+            seconds, updates = parse_profile_spec(spec)
+        except ValueError as e:
+            await m.answer(f"❌ {e}\n\n{usage}")
+            return
+
+    # В режиме шардов профиль запускает главный процесс - сразу во всех процессах
+    if _control_queue is not None:
+        _control_queue.put(("profile", (spec, m.chat.id)))
+        if spec != "stop":
+            limit = f"{seconds:g} с" if seconds else f"{updates} апдейтов"
+            await m.answer(f"📈 Профилирование всех процессов запускается на {limit}")
+        return
+
+    if spec == "stop":
+        profiler = _profiler
+        if profiler is None:
+            await m.answer("Профилирование не запущено")
+            return
+        profiler.stop()
+        if profiler.notify_chat is None:
+            profiler.notify_chat = m.chat.id
+            await _report_profile(profiler)
+        return
+
+    profiler = start_profiling(seconds, updates)
+    if profiler is None:
+        await m.answer("⏳ Профилирование уже идёт, остановить: `/profile stop`")
+        return
+    profiler.notify_chat = m.chat.id
+    limit = f"{seconds:g} с" if seconds else f"{updates} апдейтов"
+    await m.answer(f"📈 Профилирование запущено на {limit}")
+    asyncio.create_task(_report_profile(profiler))
+
 @dp.callback_query(F.data == "back_to_menu")
 async def cb_menu(c: CallbackQuery):
     await c.answer()
@@ -479,7 +2018,7 @@ async def cb_oral(c: CallbackQuery):
     user_search_state[c.from_user.id] = False
     user_current_category[c.from_user.id] = "oral"
     
-    lst = [p for p in PRODUCTS.values() if "ораль" in p["category"].lower() or "oral" in p["category"].lower()]
+    lst = category_products("oral")
     
     if not lst:
         try:
@@ -490,9 +2029,6 @@ async def cb_oral(c: CallbackQuery):
             save_message_id(c.from_user.id, msg.message_id)
         return
     
-    # Сортируем по наличию, затем по цене
-    lst.sort(key=lambda x: (-x['in_stock'], x['price']))
-    
     text = f"💊 *Оральные препараты* ({len(lst)} товаров)\n\nВыберите товар:"
     
     try:
@@ -508,7 +2044,7 @@ async def cb_inject(c: CallbackQuery):
     user_search_state[c.from_user.id] = False
     user_current_category[c.from_user.id] = "inject"
     
-    lst = [p for p in PRODUCTS.values() if "инъекц" in p["category"].lower() or "inject" in p["category"].lower()]
+    lst = category_products("inject")
     
     if not lst:
         try:
@@ -519,9 +2055,6 @@ async def cb_inject(c: CallbackQuery):
             save_message_id(c.from_user.id, msg.message_id)
         return
     
-    # Сортируем по наличию, затем по цене
-    lst.sort(key=lambda x: (-x['in_stock'], x['price']))
-    
     text = f"💉 *Инъекционные препараты* ({len(lst)} товаров)\n\nВыберите товар:"
     
     try:
@@ -544,12 +2077,10 @@ async def cb_page(c: CallbackQuery):
     user_id = c.from_user.id
     
     if category == "oral":
-        lst = [p for p in PRODUCTS.values() if "ораль" in p["category"].lower() or "oral" in p["category"].lower()]
-        lst.sort(key=lambda x: (-x['in_stock'], x['price']))
+        lst = category_products("oral")
         text = f"💊 *Оральные препараты* ({len(lst)} товаров)\n\nВыберите товар:"
     elif category == "inject":
-        lst = [p for p in PRODUCTS.values() if "инъекц" in p["category"].lower() or "inject" in p["category"].lower()]
-        lst.sort(key=lambda x: (-x['in_stock'], x['price']))
+        lst = category_products("inject")
         text = f"💉 *Инъекционные препараты* ({len(lst)} товаров)\n\nВыберите товар:"
     else:
         # Поиск или другая категория
@@ -610,6 +2141,9 @@ async def cb_product(c: CallbackQuery):
         return
     
     text = product_card_text(p)
+    if not p["in_stock"]:
+        subscribe_restock(c.from_user.id, pid)
+        text += "\n🔔 Сообщим, когда товар появится"
     kb = product_card_kb(pid)
     
     # Удаляем предыдущее сообщение
@@ -653,7 +2187,8 @@ async def cb_buy(c: CallbackQuery):
     
     product = PRODUCTS[pid]
     if not product["in_stock"]:
-        await c.answer("❌ Товар временно отсутствует", show_alert=True)
+        subscribe_restock(c.from_user.id, pid)
+        await c.answer("❌ Товар временно отсутствует\n🔔 Сообщим, когда он появится", show_alert=True)
         return
     
     add_to_cart(c.from_user.id, pid)
@@ -852,11 +2387,176 @@ async def pay_crypto(c: CallbackQuery):
 # ----------------------------
 async def on_startup():
     logger.info("🚀 Запуск улучшенного бота TitanShop...")
+    profile_on_start()
     await load_products()
     asyncio.create_task(autosync_loop())
+    asyncio.create_task(restock_fanout_loop())
+    await start_admin_api()
     logger.info("✅ Бот готов к работе!")
     logger.info(f"📦 Загружено товаров: {len(PRODUCTS)}")
 
+async def on_shutdown():
+    stats = callback_coalescing.stats()
+    logger.info(
+        f"📉 Колбэки: схлопнуто дублей {stats['collapsed']}, "
+        f"пропущено устаревших экранов {stats['dropped_stale']}, "
+        f"сэкономлено запросов к API ~{stats['saved_api_calls']}"
+    )
+    if _admin_api_runner is not None:
+        await _admin_api_runner.cleanup()
+    # Недописанный профиль сохраняем при остановке
+    await asyncio.to_thread(stop_profiling)
+
+# ----------------------------
+# SHARDED DISPATCH - НЕСКОЛЬКО ПРОЦЕССОВ-ВОРКЕРОВ
+# ----------------------------
+# Главный процесс держит long polling, загружает CSV и публикует снимки каталога.
+# Апдейты раздаются воркерам по хэшу user_id, поэтому состояние пользователя
+# (корзина, последние сообщения, поиск) живёт ровно в одном процессе.
+def shard_for_update(update: types.Update, shards: int) -> int:
+    """Номер шарда для апдейта"""
+    _, user, _ = UserContextMiddleware.resolve_event_context(update)
+    key = user.id if user else update.update_id
+    return zlib.crc32(str(key).encode()) % shards
+
+async def _process_shard_update(raw: Dict[str, Any]):
+    try:
+        await dp.feed_raw_update(bot, raw)
+    except Exception as e:
+        logger.exception(f"❌ Ошибка обработки апдейта {raw.get('update_id')}: {e}")
+
+def _next_shard_update(updates):
+    """Ждёт апдейт не дольше секунды, чтобы воркер периодически сверял версию каталога"""
+    try:
+        return updates.get(timeout=1.0)
+    except queue.Empty:
+        return {}
+
+async def _shard_worker_loop(shard: int, updates):
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    profile_on_start()
+    refresh_shared_catalog()
+    asyncio.create_task(restock_fanout_loop())
+    logger.info(f"🧩 Воркер {shard} запущен, товаров: {len(PRODUCTS)}")
+
+    while True:
+        raw = await loop.run_in_executor(None, _next_shard_update, updates)
+        if raw is None:
+            break
+        refresh_shared_catalog()
+        if isinstance(raw, tuple):
+            _shard_command(shard, *raw)
+            continue
+        if not raw:
+            continue
+        task = asyncio.create_task(_process_shard_update(raw))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks)
+    await on_shutdown()
+    await bot.session.close()
+    logger.info(f"🧩 Воркер {shard} остановлен")
+
+def _shard_worker_main(shard: int, updates, control, catalog_version, catalog_prefix: str):
+    """Точка входа процесса-воркера"""
+    global _catalog_version_ref, _catalog_prefix, _control_queue
+    # Останавливаемся только по сигналу от главного процесса, дорабатывая текущие апдейты
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _catalog_version_ref = catalog_version
+    _catalog_prefix = catalog_prefix
+    _control_queue = control
+    asyncio.run(_shard_worker_loop(shard, updates))
+
+async def _supervise_workers(processes: List[multiprocessing.Process], start_worker: Callable[[int], multiprocessing.Process]):
+    """Перезапускает упавших воркеров: их очередь апдейтов подхватит новый процесс"""
+    while True:
+        await asyncio.sleep(WORKER_CHECK_INTERVAL_SEC)
+        for i, p in enumerate(processes):
+            if not p.is_alive():
+                logger.error(f"💀 Воркер {i} завершился (код {p.exitcode}), перезапускаем")
+                processes[i] = start_worker(i)
+
+async def run_sharded(workers: int):
+    """Главный процесс режима шардов"""
+    global _catalog_version_ref, _catalog_prefix, _is_catalog_publisher, _worker_queues, _profile_reports
+    ctx = multiprocessing.get_context("spawn")
+    _catalog_version_ref = ctx.Value("Q", 0)
+    _catalog_prefix = os.path.join(CATALOG_SHM_DIR, f"titanshop-catalog-{os.getpid()}")
+    _is_catalog_publisher = True
+
+    logger.info(f"🚀 Запуск TitanShop в режиме шардов: {workers} воркеров")
+    profile_on_start()
+    await load_products()
+
+    queues = [ctx.Queue() for _ in range(workers)]
+    control = ctx.Queue()
+    _worker_queues = queues
+    _profile_reports = asyncio.Queue()
+
+    def start_worker(i: int) -> multiprocessing.Process:
+        p = ctx.Process(
+            target=_shard_worker_main,
+            args=(i, queues[i], control, _catalog_version_ref, _catalog_prefix),
+            name=f"titanshop-shard-{i}",
+        )
+        p.start()
+        return p
+
+    processes = [start_worker(i) for i in range(workers)]
+
+    sync_task = asyncio.create_task(autosync_loop())
+    control_task = asyncio.create_task(_control_loop(control))
+    supervisor_task = asyncio.create_task(_supervise_workers(processes, start_worker))
+    await start_admin_api()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    logger.info("✅ Бот готов к работе!")
+
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset,
+                    timeout=30,
+                    allowed_updates=allowed_updates,
+                    request_timeout=int(bot.session.timeout + 30),
+                )
+            except Exception as e:
+                logger.error(f"❌ Ошибка получения апдейтов: {e}")
+                await asyncio.sleep(5)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                shard = shard_for_update(update, workers)
+                queues[shard].put(update.model_dump(mode="json", exclude_none=True))
+                if _profiler is not None:
+                    _profiler.update_done()
+    finally:
+        sync_task.cancel()
+        control_task.cancel()
+        supervisor_task.cancel()
+        for q in queues:
+            q.put(None)
+        for p in processes:
+            p.join(timeout=30)
+        if _admin_api_runner is not None:
+            await _admin_api_runner.cleanup()
+        await asyncio.to_thread(stop_profiling)
+        for version in list(_published_snapshots):
+            remove_catalog_snapshot(version)
+        await bot.session.close()
+
 if __name__ == "__main__":
-    dp.startup.register(on_startup)
-    dp.run_polling(bot)
+    if WORKER_PROCESSES > 1:
+        asyncio.run(run_sharded(WORKER_PROCESSES))
+    else:
+        dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
+        # Апдейты обрабатываются задачами параллельно, порядок внутри пользователя
+        # обеспечивает UserSerializationMiddleware
+        dp.run_polling(bot, handle_as_tasks=True)